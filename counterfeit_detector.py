@@ -5,17 +5,176 @@ This module implements algorithms to detect copied, screenshot, or
 physically reproduced QR codes by analyzing security features.
 """
 
+import base64
 import hashlib
 import json
+import math
+from functools import lru_cache
 import numpy as np
 import cv2
 from PIL import Image
-from scipy.fftpack import dct
-from scipy.stats import pearsonr
-from typing import Dict, Tuple, List
+from typing import Dict, Tuple, List, NamedTuple, Optional, Union
 import piexif
 
 
+class PreparedMetadata(NamedTuple):
+    """Security metadata unpacked into the arrays the detector works on."""
+    ghost_count: Optional[int]               # None when no ghost pattern was stored
+    ghost_xs: np.ndarray                     # int32 x coordinates of ghost dots
+    ghost_ys: np.ndarray                     # int32 y coordinates of ghost dots
+    ghost_lo: np.ndarray                     # uint8 lowest gray value accepted per dot
+    ghost_hi: np.ndarray                     # uint8 highest gray value accepted per dot
+    watermark_signature: np.ndarray          # float32 DCT watermark signature
+    image_size: Optional[Tuple[int, int]]    # (height, width) at generation time
+    fingerprint_hash: str
+
+
+def prepare_security_metadata(security_metadata: Dict) -> PreparedMetadata:
+    """
+    Unpack security metadata (as stored in the database) into numpy arrays.
+    
+    Metadata never changes once a document is created, so callers that verify
+    the same document repeatedly can prepare it once and reuse the result.
+    
+    Args:
+        security_metadata: Original security metadata dictionary
+        
+    Returns:
+        PreparedMetadata ready for CounterfeitDetector.verify_qr_authenticity
+    """
+    ghost_pattern = security_metadata.get('ghost_pattern') or {}
+    
+    if 'xs' in ghost_pattern:
+        # security_version 2: parallel xs/ys/vals arrays
+        ghost_count = ghost_pattern['count']
+        ghost_xs = np.asarray(ghost_pattern['xs'], dtype=np.int32)
+        ghost_ys = np.asarray(ghost_pattern['ys'], dtype=np.int32)
+        ghost_values = np.asarray(ghost_pattern['vals'], dtype=np.int32)
+    else:
+        # security_version 1: list of {'x', 'y', 'value'} dicts
+        coords = ghost_pattern.get('coordinates')
+        
+        if coords is None:
+            ghost_count = None
+            coords = []
+        else:
+            ghost_count = ghost_pattern['count']
+        
+        ghost_xs = np.fromiter((c['x'] for c in coords), dtype=np.int32, count=len(coords))
+        ghost_ys = np.fromiter((c['y'] for c in coords), dtype=np.int32, count=len(coords))
+        ghost_values = np.fromiter((c['value'] for c in coords), dtype=np.int32, count=len(coords))
+    
+    ghost_lo, ghost_hi = _ghost_value_windows(ghost_values)
+    
+    signature = _decode_watermark_signature(
+        security_metadata.get('watermark_signature', []),
+        security_metadata.get('watermark_shape')
+    )
+    
+    return PreparedMetadata(
+        ghost_count=ghost_count,
+        ghost_xs=ghost_xs,
+        ghost_ys=ghost_ys,
+        ghost_lo=ghost_lo,
+        ghost_hi=ghost_hi,
+        watermark_signature=signature,
+        image_size=security_metadata.get('image_size'),
+        fingerprint_hash=security_metadata.get('fingerprint_hash') or ''
+    )
+
+
+def _decode_watermark_signature(signature: Union[str, List], shape: Optional[List[int]]) -> np.ndarray:
+    """
+    Load a stored watermark signature as a float32 array.
+    
+    Current metadata stores the signature as base64-encoded little-endian
+    float32 bytes plus its shape; older metadata stores nested lists.
+    
+    Args:
+        signature: Base64 string or nested list of floats
+        shape: Signature shape; base64 signatures without one are assumed square
+        
+    Returns:
+        float32 signature array
+    """
+    if not isinstance(signature, str):
+        return np.array(signature, dtype=np.float32)
+    
+    values = np.frombuffer(base64.b64decode(signature), dtype='<f4').astype(np.float32)
+    if shape is None:
+        side = math.isqrt(values.size)
+        shape = (side, side) if side * side == values.size else (values.size,)
+    return values.reshape(shape)
+
+
+def _ghost_value_windows(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Fold the ghost dot acceptance test into one uint8 range per dot.
+    
+    A dot is detected when its gray value is at least 245 and within 5 of
+    its expected value, i.e. inside [max(245, value - 5), value + 5].
+    
+    Args:
+        values: Expected gray value per dot
+        
+    Returns:
+        (lo, hi) uint8 arrays; dots that can never match get an empty range
+    """
+    lo = np.maximum(values - 5, 245)
+    hi = values + 5
+    impossible = (lo > hi) | (lo > 255)
+    lo = np.where(impossible, 255, lo)
+    hi = np.where(impossible, 0, np.minimum(hi, 255))
+    return lo.astype(np.uint8), hi.astype(np.uint8)
+
+
+@lru_cache(maxsize=64)
+def _dct_basis_rows(n: int, start: int, count: int) -> np.ndarray:
+    """
+    Rows start..start+count of the orthonormal n-point DCT-II matrix.
+    
+    Rows past n are dropped, so the result may be shorter than count.
+    
+    Args:
+        n: Transform length
+        start: First coefficient index
+        count: Number of coefficients
+        
+    Returns:
+        Read-only float32 array of shape (rows, n)
+    """
+    k = np.arange(start, min(start + count, n), dtype=np.float64)[:, None]
+    x = np.arange(n, dtype=np.float64)[None, :]
+    basis = np.cos(np.pi * (2 * x + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    basis[k[:, 0] == 0] *= np.sqrt(0.5)
+    basis = basis.astype(np.float32)
+    basis.setflags(write=False)
+    return basis
+
+
+def _watermark_basis(
+    image_shape: Tuple[int, int],
+    signature_shape: Tuple[int, int]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    DCT basis rows and columns covering the watermark's mid-frequency block.
+    
+    The block starts a quarter of the way into each axis, matching where
+    the generator embeds the signature.
+    
+    Args:
+        image_shape: (height, width) of the image being analysed
+        signature_shape: (rows, cols) of the watermark signature
+        
+    Returns:
+        (row_basis, col_basis) such that row_basis @ image @ col_basis.T is
+        the signature-sized block of the image's orthonormal 2D DCT
+    """
+    h, w = image_shape
+    sig_h, sig_w = signature_shape
+    return _dct_basis_rows(h, h // 4, sig_h), _dct_basis_rows(w, w // 4, sig_w)
+
+
 class CounterfeitDetector:
     """Detect counterfeit QR codes using multi-layer analysis."""
     
@@ -37,44 +196,55 @@ class CounterfeitDetector:
     def verify_qr_authenticity(
         self,
         scanned_image: np.ndarray,
-        security_metadata: Dict
+        security_metadata: Union[Dict, PreparedMetadata],
+        gray: Optional[np.ndarray] = None
     ) -> Dict:
         """
         Verify the authenticity of a scanned QR code.
         
         Args:
             scanned_image: Scanned QR code as numpy array
-            security_metadata: Original security metadata from database
+            security_metadata: Original security metadata from database, either
+                as stored or already unpacked by prepare_security_metadata
+            gray: Grayscale version of scanned_image if the caller already has
+                one (e.g. from decoding); computed from an RGB image otherwise
             
         Returns:
             Dictionary containing verification results and authenticity score
         """
+        if not isinstance(security_metadata, PreparedMetadata):
+            security_metadata = prepare_security_metadata(security_metadata)
+        
+        # Convert to grayscale once; every stage except the fingerprint works on it
+        if gray is None:
+            if scanned_image.ndim == 3:
+                gray = cv2.cvtColor(scanned_image, cv2.COLOR_RGB2GRAY)
+            else:
+                gray = scanned_image
+        
         results = {}
         
         # 1. Ghost Dot Detection
-        ghost_result = self._detect_ghost_dots(
-            scanned_image,
-            security_metadata.get('ghost_pattern', {})
-        )
+        ghost_result = self._detect_ghost_dots(gray, security_metadata)
         results['ghost_dots'] = ghost_result
         
         # 2. Frequency Watermark Verification
         freq_result = self._verify_frequency_watermark(
-            scanned_image,
-            np.array(security_metadata.get('watermark_signature', [])),
-            expected_size=security_metadata.get('image_size')
+            gray,
+            security_metadata.watermark_signature,
+            expected_size=security_metadata.image_size
         )
         results['frequency_watermark'] = freq_result
         
         # 3. Pixel Fingerprint Analysis
         fingerprint_result = self._analyze_pixel_fingerprint(
             scanned_image,
-            security_metadata.get('fingerprint_hash', '')
+            security_metadata.fingerprint_hash
         )
         results['pixel_fingerprint'] = fingerprint_result
         
         # 4. Metadata Analysis
-        metadata_result = self._analyze_metadata(scanned_image)
+        metadata_result = self._analyze_metadata(gray)
         results['metadata'] = metadata_result
         
         # Calculate overall authenticity score
@@ -105,8 +275,8 @@ class CounterfeitDetector:
     
     def _detect_ghost_dots(
         self,
-        img_array: np.ndarray,
-        ghost_pattern: Dict
+        gray: np.ndarray,
+        metadata: PreparedMetadata
     ) -> Dict:
         """
         Detect ghost dots in the scanned image.
@@ -115,13 +285,13 @@ class CounterfeitDetector:
         color quantization and print/scan degradation.
         
         Args:
-            img_array: Scanned QR code image
-            ghost_pattern: Original ghost dot pattern
+            gray: Scanned QR code image in grayscale
+            metadata: Prepared security metadata holding the ghost dot pattern
             
         Returns:
             Detection result dictionary
         """
-        if not ghost_pattern or 'coordinates' not in ghost_pattern:
+        if metadata.ghost_count is None:
             return {
                 'score': 0,
                 'detected': 0,
@@ -129,8 +299,7 @@ class CounterfeitDetector:
                 'status': 'NO_PATTERN'
             }
         
-        expected_coords = ghost_pattern['coordinates']
-        expected_count = ghost_pattern['count']
+        expected_count = metadata.ghost_count
         
         if expected_count == 0:
             return {
@@ -140,28 +309,23 @@ class CounterfeitDetector:
                 'status': 'PASS'
             }
         
-        # Check each expected ghost dot location
-        detected = 0
-        height, width = img_array.shape[:2]
+        height, width = gray.shape[:2]
         
-        for coord in expected_coords:
-            x, y = coord['x'], coord['y']
-            expected_value = coord['value']
-            
-            # Check if coordinates are within image bounds
-            if y >= height or x >= width:
-                continue
-            
-            # Get pixel value
-            pixel = img_array[y, x]
-            pixel_gray = int(np.mean(pixel))
-            
-            # Ghost dots should be in range 250-254
-            # Allow some tolerance for camera noise
-            if 245 <= pixel_gray <= 255:
-                # Check if it's close to expected value
-                if abs(pixel_gray - expected_value) <= 5:
-                    detected += 1
+        # Drop coordinates outside the image bounds
+        xs, ys = metadata.ghost_xs, metadata.ghost_ys
+        lo, hi = metadata.ghost_lo, metadata.ghost_hi
+        in_bounds = (ys < height) & (xs < width)
+        if not in_bounds.all():
+            xs, ys, lo, hi = xs[in_bounds], ys[in_bounds], lo[in_bounds], hi[in_bounds]
+        
+        # Gather every expected ghost dot location in one indexing op
+        pixel_gray = gray[ys, xs]
+        
+        # Ghost dots should be in range 250-254 (allow some tolerance for
+        # camera noise) and close to their expected value; both conditions are
+        # folded into the precomputed per-dot [lo, hi] window, so the test
+        # stays in uint8 end to end
+        detected = int(np.count_nonzero((pixel_gray >= lo) & (pixel_gray <= hi)))
         
         # Calculate detection rate
         detection_rate = (detected / expected_count) * 100 if expected_count > 0 else 0
@@ -183,7 +347,7 @@ class CounterfeitDetector:
     
     def _verify_frequency_watermark(
         self,
-        img_array: np.ndarray,
+        gray_image: np.ndarray,
         original_signature: np.ndarray,
         expected_size: Tuple[int, int] = None
     ) -> Dict:
@@ -193,7 +357,7 @@ class CounterfeitDetector:
         Watermark degrades with compression and print/scan cycles.
         
         Args:
-            img_array: Scanned QR code image
+            gray_image: Scanned QR code image in grayscale
             original_signature: Original watermark signature
             expected_size: Expected image dimensions (height, width) from metadata
             
@@ -208,11 +372,8 @@ class CounterfeitDetector:
             }
         
         try:
-            # Convert to grayscale
-            if len(img_array.shape) == 3:
-                gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY).astype(float)
-            else:
-                gray = img_array.astype(float)
+            # float32 is ample for a correlation score and halves the bytes per pixel
+            gray = gray_image.astype(np.float32)
                 
             # CRITICAL: Resize to match the original generation size exactly
             # DCT frequency bins depend on image size. If sizes mismatch, we look at wrong frequencies.
@@ -221,18 +382,20 @@ class CounterfeitDetector:
                 # cv2.resize expects (width, height)
                 target_h, target_w = expected_size[0], expected_size[1]
                 if gray.shape != (target_h, target_w):
-                    gray = cv2.resize(gray, (target_w, target_h), interpolation=cv2.INTER_LANCZOS4)
-            
-            # Apply DCT
-            dct_coeffs = dct(dct(gray.T, norm='ortho').T, norm='ortho')
-            dct_coeffs = dct(dct(gray.T, norm='ortho').T, norm='ortho')
-            
-            # Extract watermark from mid-frequency region
-            h, w = dct_coeffs.shape
-            mid_h, mid_w = h // 4, w // 4
-            
-            sig_h, sig_w = original_signature.shape
-            extracted = dct_coeffs[mid_h:mid_h+sig_h, mid_w:mid_w+sig_w]
+                    # Area averaging for downscale, bicubic for upscale: both are far
+                    # cheaper than the 8x8-tap Lanczos kernel and keep the mid band intact
+                    if target_h * target_w < gray.shape[0] * gray.shape[1]:
+                        interpolation = cv2.INTER_AREA
+                    else:
+                        interpolation = cv2.INTER_CUBIC
+                    gray = cv2.resize(gray, (target_w, target_h), interpolation=interpolation)
+            
+            # Extract watermark from mid-frequency region. The 2D DCT is separable,
+            # so only the signature-sized block is computed: (rows @ image @ cols.T)
+            # instead of transforming the whole image and slicing. The basis rows are
+            # lru-cached per image size, so repeat scans reuse them
+            row_basis, col_basis = _watermark_basis(gray.shape, original_signature.shape)
+            extracted = row_basis @ gray @ col_basis.T
             
             # Ensure same shape
             if extracted.shape != original_signature.shape:
@@ -242,15 +405,14 @@ class CounterfeitDetector:
                     'status': 'SIZE_MISMATCH'
                 }
             
-            # Calculate correlation
-            correlation, _ = pearsonr(
-                original_signature.flatten(),
-                extracted.flatten()
-            )
+            # Calculate Pearson correlation directly (zero-mean both vectors, then a
+            # normalised dot product); scipy's pearsonr also computes an unused p-value
+            a = original_signature.ravel() - original_signature.mean()
+            b = extracted.ravel() - extracted.mean()
+            denom = float(np.linalg.norm(a) * np.linalg.norm(b))
             
-            # Handle NaN
-            if np.isnan(correlation):
-                correlation = 0
+            # Constant input has no defined correlation
+            correlation = float(a @ b) / denom if denom else 0.0
             
             # Score based on correlation
             # Original: 0.85-1.0
@@ -300,31 +462,19 @@ class CounterfeitDetector:
         try:
             height, width = img_array.shape[:2]
             
-            # Extract pixels in grid pattern (same as embedding)
+            # Extract pixels in grid pattern (same as embedding) as a strided view
             step = 5
-            y_coords, x_coords = np.meshgrid(
-                range(step, height, step),
-                range(step, width, step),
-                indexing='ij'
-            )
+            pixel_values = img_array[step:height:step, step:width:step]
             
-            # Analyze noise characteristics
-            pixel_values = []
-            for y, x in zip(y_coords.flatten(), x_coords.flatten()):
-                if y < height and x < width:
-                    pixel_values.append(img_array[y, x])
-            
-            if not pixel_values:
+            if pixel_values.size == 0:
                 return {
                     'score': 0,
                     'integrity': 0,
                     'status': 'NO_PIXELS'
                 }
             
-            pixel_values = np.array(pixel_values)
-            
             # Calculate noise variance (should be consistent in original)
-            variance = np.var(pixel_values)
+            variance = float(np.var(pixel_values))
             
             # Original images have controlled noise variance
             # Copies have reduced variance due to smoothing
@@ -357,7 +507,7 @@ class CounterfeitDetector:
                 'status': f'ERROR: {str(e)}'
             }
     
-    def _analyze_metadata(self, img_array: np.ndarray) -> Dict:
+    def _analyze_metadata(self, gray: np.ndarray) -> Dict:
         """
         Analyze image metadata for screenshot indicators.
         
@@ -365,7 +515,7 @@ class CounterfeitDetector:
         software signatures.
         
         Args:
-            img_array: Scanned QR code image (note: metadata is lost in numpy array)
+            gray: Scanned QR code image in grayscale (note: metadata is lost in numpy array)
             
         Returns:
             Metadata analysis result
@@ -377,9 +527,16 @@ class CounterfeitDetector:
         # Screenshots often have different compression artifacts
         
         try:
-            # Analyze image sharpness (Laplacian variance)
-            gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
-            laplacian_var = cv2.Laplacian(gray, cv2.CV_64F).var()
+            # Analyze image sharpness (Laplacian variance). The 4-neighbour Laplacian
+            # is evaluated on every 4th interior pixel in int16, which estimates the
+            # same variance as a full-image float64 cv2.Laplacian at 1/16 the work
+            pixels = gray.astype(np.int16)
+            laplacian = (
+                pixels[0:-2:4, 1:-1:4] + pixels[2::4, 1:-1:4] +
+                pixels[1:-1:4, 0:-2:4] + pixels[1:-1:4, 2::4] -
+                4 * pixels[1:-1:4, 1:-1:4]
+            )
+            laplacian_var = float(laplacian.var()) if laplacian.size else 0.0
             
             # Original camera images: higher variance (sharper)
             # Screenshots: lower variance (smoother)
@@ -412,9 +569,59 @@ class CounterfeitDetector:
             }
 
 
+# Shared detector for the convenience functions (holds only thresholds and weights)
+_DETECTOR = CounterfeitDetector()
+
+
+def get_detector() -> CounterfeitDetector:
+    """Return the shared detector (it holds no per-request state)."""
+    return _DETECTOR
+
+
+def _decode_image(image_bytes: bytes) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Decode an image into a colour array and its grayscale version.
+    
+    OpenCV decodes straight into a numpy buffer. Its BGR channel order is kept
+    as-is: the only colour stage (pixel fingerprint) is a variance over all
+    channels and does not depend on their order. EXIF orientation is ignored,
+    as it is when decoding with PIL. Formats OpenCV cannot read fall back to PIL.
+    
+    Args:
+        image_bytes: Encoded image
+        
+    Returns:
+        (color, gray) numpy arrays
+    """
+    color = cv2.imdecode(
+        np.frombuffer(image_bytes, dtype=np.uint8),
+        cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION
+    )
+    
+    if color is not None:
+        return color, cv2.cvtColor(color, cv2.COLOR_BGR2GRAY)
+    
+    from io import BytesIO
+    img = Image.open(BytesIO(image_bytes))
+    
+    # View the decoded pixels directly where possible instead of copying through
+    # convert('RGB'); grayscale needs no colour array at all since the
+    # fingerprint variance is the same over replicated channels
+    if img.mode == 'L':
+        gray = np.asarray(img)
+        return gray, gray
+    if img.mode == 'RGB':
+        color = np.asarray(img)
+    elif img.mode == 'RGBA':
+        color = np.asarray(img)[..., :3]
+    else:
+        color = np.asarray(img.convert('RGB'))
+    return color, cv2.cvtColor(color, cv2.COLOR_RGB2GRAY)
+
+
 def verify_qr_code(
     scanned_image_path: str,
-    security_metadata: Dict
+    security_metadata: Union[Dict, PreparedMetadata]
 ) -> Dict:
     """
     Convenience function to verify a QR code from file path.
@@ -426,18 +633,13 @@ def verify_qr_code(
     Returns:
         Verification results dictionary
     """
-    # Load image
-    img = Image.open(scanned_image_path)
-    img_array = np.array(img.convert('RGB'))
-    
-    # Verify
-    detector = CounterfeitDetector()
-    return detector.verify_qr_authenticity(img_array, security_metadata)
+    with open(scanned_image_path, 'rb') as f:
+        return verify_qr_code_bytes(f.read(), security_metadata)
 
 
 def verify_qr_code_bytes(
     image_bytes: bytes,
-    security_metadata: Dict
+    security_metadata: Union[Dict, PreparedMetadata]
 ) -> Dict:
     """
     Convenience function to verify a QR code from image bytes.
@@ -449,11 +651,8 @@ def verify_qr_code_bytes(
     Returns:
         Verification results dictionary
     """
-    # Load image from bytes
-    from io import BytesIO
-    img = Image.open(BytesIO(image_bytes))
-    img_array = np.array(img.convert('RGB'))
+    # Decode image once into colour and grayscale
+    color, gray = _decode_image(image_bytes)
     
     # Verify
-    detector = CounterfeitDetector()
-    return detector.verify_qr_authenticity(img_array, security_metadata)
+    return _DETECTOR.verify_qr_authenticity(color, security_metadata, gray=gray)
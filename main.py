@@ -1,23 +1,41 @@
+import asyncio
 import hashlib
+import hmac
+import queue
+import re
 import secrets
 import sqlite3
-from datetime import datetime, timedelta
-from typing import Optional
-from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Form
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Form, Request
 from fastapi.responses import Response, FileResponse, RedirectResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, EmailStr
-from qr_utils import generate_qr_code
 from secure_qr_generator import generate_secure_qr_code
-from counterfeit_detector import verify_qr_code_bytes
-from pdf_utils import stamp_pdf_with_qr, extract_qr_from_pdf
+from counterfeit_detector import get_detector, verify_qr_code_bytes, prepare_security_metadata, PreparedMetadata
+from pdf_utils import stamp_pdf_with_qr_async, shutdown_stamp_executor, extract_qr_from_pdf
 import os
 import json
-import base64
+import aiofiles
+from dotenv import load_dotenv
 
-app = FastAPI(title="Secure PDF QR System")
+load_dotenv()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Run background housekeeping for as long as the app is up."""
+    purge_task = asyncio.create_task(purge_expired_tokens_periodically())
+    yield
+    purge_task.cancel()
+    shutdown_stamp_executor()
+
+app = FastAPI(title="Secure PDF QR System", lifespan=lifespan)
 
 # Enable CORS
 app.add_middleware(
@@ -34,44 +52,118 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 # Security
 security = HTTPBearer()
 
+# Public base URL embedded in QR codes and returned links. Read once at startup
+# so every QR (upload and re-stamp) encodes the same verify URL.
+BASE_URL = os.getenv("BASE_URL", "http://127.0.0.1:8000")
+
 # Database setup
 DB_PATH = "secure_qr.db"
 
+# Uploaded PDFs are kept on disk and streamed back with sendfile
+PDF_DIR = "pdfs"
+
+# Generated QR code images
+QR_DIR = "qr_codes"
+
+# Accepted file types for scanned QR images
+ALLOWED_IMAGE_EXTENSIONS = frozenset({'.png', '.jpg', '.jpeg', '.bmp', '.webp'})
+
+# Uploads are streamed to disk in chunks of this size
+FILE_CHUNK_SIZE = 64 * 1024
+
+# Token lifetimes. Expiry times are stored as integer Unix epochs so checks
+# are plain integer comparisons.
+ACCESS_TOKEN_TTL_SECONDS = 24 * 60 * 60
+DOWNLOAD_TOKEN_TTL_SECONDS = 60
+
+# QR images never change once generated, so clients may cache them for a year
+QR_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# How often expired access tokens and download links are deleted
+TOKEN_PURGE_INTERVAL_SECONDS = 600
+
+# Connections are opened once and pooled. The database runs in WAL mode, which
+# lets any number of readers proceed alongside a single writer, so requests
+# on different pooled connections no longer serialize behind one another.
+DB_POOL_SIZE = 8
+_db_pool: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+
+# Access tokens are never revoked before they expire, so a token that has been
+# seen once can be trusted from memory until its expiry
+TOKEN_CACHE_MAX_SIZE = 10_000
+_token_cache: Dict[str, Tuple[int, int]] = {}
+_token_cache_lock = threading.Lock()
+
+# Password hashing: salted PBKDF2-HMAC-SHA256 from the standard library.
+# 600,000 iterations is OWASP's recommendation for PBKDF2-HMAC-SHA256 and costs
+# about 0.3s of CPU per hash, roughly a bcrypt cost factor of 12. Hashing runs in
+# a worker thread, not on the event loop. Raising the count upgrades existing
+# hashes on their next login (see password_needs_rehash).
+PASSWORD_HASH_ALGORITHM = "pbkdf2_sha256"
+PASSWORD_HASH_ITERATIONS = 600_000
+
+def _connect() -> sqlite3.Connection:
+    """Open a database connection with the per-connection tuning applied."""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    
+    # Fewer fsyncs, in-memory temp tables, mmap'd reads, ~20MB page cache
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA cache_size=-20000")
+    return conn
+
+@contextmanager
+def get_conn():
+    """Borrow a pooled connection (autocommit unless a transaction is begun)."""
+    conn = _db_pool.get()
+    try:
+        yield conn
+    finally:
+        # Don't hand a half-finished transaction to the next borrower
+        if conn.in_transaction:
+            conn.rollback()
+        _db_pool.put(conn)
+
 def init_db():
-    """Initialize SQLite database with required tables."""
-    conn = sqlite3.connect(DB_PATH)
+    """Initialize SQLite database with required tables and fill the connection pool."""
+    conn = _connect()
     cursor = conn.cursor()
     
-    # Users table
-    cursor.execute("""
+    # WAL journal is a property of the database file and persists across
+    # connections; the schema itself is created in one transaction
+    cursor.executescript("""
+        PRAGMA journal_mode=WAL;
+        
+        BEGIN;
+        
+        -- Users table
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             email TEXT UNIQUE NOT NULL,
             password_hash TEXT NOT NULL,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    
-    # Access tokens table
-    cursor.execute("""
+        );
+        
+        -- Access tokens table
         CREATE TABLE IF NOT EXISTS tokens (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER NOT NULL,
             token TEXT UNIQUE NOT NULL,
-            expires_at TIMESTAMP NOT NULL,
+            expires_at INTEGER NOT NULL,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (user_id) REFERENCES users(id)
-        )
-    """)
-    
-    # PDF documents table
-    cursor.execute("""
+        );
+        
+        -- PDF documents table
         CREATE TABLE IF NOT EXISTS documents (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             unique_id TEXT UNIQUE NOT NULL,
             user_id INTEGER NOT NULL,
             filename TEXT NOT NULL,
             pdf_data BLOB NOT NULL,
+            pdf_path TEXT,
+            content_hash TEXT,
             scan_limit INTEGER NOT NULL,
             scan_count INTEGER DEFAULT 0,
             ghost_pattern TEXT,
@@ -80,14 +172,61 @@ def init_db():
             security_version INTEGER DEFAULT 1,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (user_id) REFERENCES users(id)
-        )
+        );
+        
+        -- Single-use links for downloading a PDF after a successful secure scan
+        CREATE TABLE IF NOT EXISTS download_tokens (
+            token TEXT PRIMARY KEY,
+            unique_id TEXT NOT NULL,
+            expires_at INTEGER NOT NULL
+        );
+        
+        -- Covering index so verify_token is answered from the index alone. Lookups on
+        -- users.email and documents.unique_id already use their UNIQUE indexes.
+        CREATE INDEX IF NOT EXISTS idx_tokens_token_expires ON tokens(token, expires_at, user_id);
+        
+        COMMIT;
     """)
     
-    conn.commit()
-    conn.close()
+    # Migrate databases created before PDFs moved to disk / were hashed
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(documents)")}
+    for column in ('pdf_path', 'content_hash'):
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE documents ADD COLUMN {column} TEXT")
+    
+    # Migrate token expiry times stored as timestamp strings to Unix epochs
+    for table in ('tokens', 'download_tokens'):
+        cursor.execute(
+            f"""UPDATE {table} SET expires_at = CAST(strftime('%s', expires_at) AS INTEGER)
+                WHERE typeof(expires_at) = 'text'"""
+        )
+    
+    _db_pool.put(conn)
+    for _ in range(DB_POOL_SIZE - 1):
+        _db_pool.put(_connect())
+
+def purge_expired_tokens():
+    """Delete expired access tokens and download links in one transaction."""
+    now = int(time.time())
+    with get_conn() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM tokens WHERE expires_at < ?", (now,))
+        conn.execute("DELETE FROM download_tokens WHERE expires_at < ?", (now,))
+        conn.execute("COMMIT")
+
+async def purge_expired_tokens_periodically():
+    """Background task: purge expired tokens every TOKEN_PURGE_INTERVAL_SECONDS."""
+    while True:
+        try:
+            await asyncio.to_thread(purge_expired_tokens)
+        except sqlite3.Error as e:
+            print(f"Error purging expired tokens: {e}")
+        await asyncio.sleep(TOKEN_PURGE_INTERVAL_SECONDS)
 
 # Initialize database on startup
 init_db()
+os.makedirs(PDF_DIR, exist_ok=True)
+os.makedirs(QR_DIR, exist_ok=True)
 
 # Pydantic models
 class LoginRequest(BaseModel):
@@ -106,60 +245,376 @@ class DocumentResponse(BaseModel):
     qr_url: str
 
 # Helper functions
+def file_extension(filename: str) -> str:
+    """Lower-cased extension of an uploaded file's name, including the dot."""
+    return os.path.splitext(filename)[1].lower()
+
+def weak_etag(tag: str) -> str:
+    """An entity tag with surrounding whitespace and any W/ (weak) prefix removed."""
+    tag = tag.strip()
+    return tag[2:] if tag.startswith("W/") else tag
+
+async def read_pdf(pdf_path: Optional[str], pdf_data: Optional[bytes]) -> bytes:
+    """Load a document's PDF bytes from disk, falling back to the legacy BLOB column."""
+    if pdf_path:
+        async with aiofiles.open(pdf_path, "rb") as f:
+            return await f.read()
+    return pdf_data
+
+def pdf_response(
+    filename: str,
+    pdf_path: Optional[str],
+    pdf_data: Optional[bytes],
+    headers: Optional[Dict[str, str]] = None
+) -> Response:
+    """Send a document's PDF, streamed from disk or from the legacy BLOB column."""
+    if pdf_path:
+        return FileResponse(pdf_path, media_type="application/pdf", filename=filename, headers=headers)
+    
+    return Response(
+        content=pdf_data,
+        media_type="application/pdf",
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            **(headers or {})
+        }
+    )
+
+async def verify_image_async(image_bytes: bytes, security_metadata: PreparedMetadata) -> dict:
+    """
+    Run counterfeit detection on an uploaded image in a worker thread.
+    
+    Decoding and analysis are CPU-bound; OpenCV and NumPy release the GIL,
+    so concurrent verifications proceed in parallel instead of blocking
+    the event loop.
+    """
+    return await asyncio.to_thread(verify_qr_code_bytes, image_bytes, security_metadata)
+
+
+def load_security_metadata(unique_id: str) -> Optional[PreparedMetadata]:
+    """
+    Fetch a document's security metadata, unpacked for the detector.
+    
+    Returns None if the document does not exist.
+    """
+    try:
+        return _load_security_metadata_cached(unique_id)
+    except KeyError:
+        return None
+
+@lru_cache(maxsize=1024)
+def _load_security_metadata_cached(unique_id: str) -> PreparedMetadata:
+    """
+    Fetch and unpack a document's security metadata, raising KeyError if missing.
+    
+    Metadata is written once at upload and never modified, so repeated scans of
+    the same document reuse the parsed arrays instead of re-reading and
+    re-parsing the JSON columns. Misses raise rather than return None because
+    lru_cache does not store exceptions, so probing unknown ids cannot evict
+    real documents.
+    """
+    with get_conn() as conn:
+        row = conn.execute(
+            """SELECT ghost_pattern, frequency_signature, fingerprint_hash
+               FROM documents WHERE unique_id = ?""",
+            (unique_id,)
+        ).fetchone()
+    
+    if not row:
+        raise KeyError(unique_id)
+    
+    ghost_pattern_json, freq_sig_json, fingerprint_hash = row
+    return prepare_security_metadata({
+        'ghost_pattern': json.loads(ghost_pattern_json) if ghost_pattern_json else {},
+        'watermark_signature': json.loads(freq_sig_json) if freq_sig_json else [],
+        'fingerprint_hash': fingerprint_hash or ''
+    })
+
 def hash_password(password: str) -> str:
-    """Hash password using SHA-256."""
-    return hashlib.sha256(password.encode()).hexdigest()
+    """Hash password with a random salt using PBKDF2-HMAC-SHA256."""
+    salt = secrets.token_bytes(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, PASSWORD_HASH_ITERATIONS)
+    return f"{PASSWORD_HASH_ALGORITHM}${PASSWORD_HASH_ITERATIONS}${salt.hex()}${digest.hex()}"
+
+def verify_password(password: str, password_hash: str) -> bool:
+    """Check a password against a stored hash (PBKDF2 or legacy unsalted SHA-256)."""
+    if password_hash.startswith(f"{PASSWORD_HASH_ALGORITHM}$"):
+        # A malformed hash (wrong field count, bad hex or iteration count) never matches
+        try:
+            _, iterations, salt_hex, digest_hex = password_hash.split("$")
+            salt, expected = bytes.fromhex(salt_hex), bytes.fromhex(digest_hex)
+            digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, int(iterations))
+        except (ValueError, OverflowError):
+            return False
+        return hmac.compare_digest(digest, expected)
+    
+    # Accounts created before salted hashing store a bare SHA-256 hex digest
+    legacy_hash = hashlib.sha256(password.encode()).hexdigest()
+    return hmac.compare_digest(legacy_hash, password_hash)
+
+def password_needs_rehash(password_hash: str) -> bool:
+    """Whether a stored hash is legacy SHA-256 or uses fewer than the current PBKDF2 iterations."""
+    if not password_hash.startswith(f"{PASSWORD_HASH_ALGORITHM}$"):
+        return True
+    try:
+        return int(password_hash.split("$")[1]) < PASSWORD_HASH_ITERATIONS
+    except ValueError:
+        return True
 
 def create_access_token(user_id: int) -> str:
     """Create a new access token for user."""
     token = secrets.token_urlsafe(32)
-    expires_at = datetime.utcnow() + timedelta(hours=24)
+    expires_at = int(time.time()) + ACCESS_TOKEN_TTL_SECONDS
     
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO tokens (user_id, token, expires_at) VALUES (?, ?, ?)",
-        (user_id, token, expires_at)
-    )
-    conn.commit()
-    conn.close()
+    with get_conn() as conn:
+        conn.execute(
+            "INSERT INTO tokens (user_id, token, expires_at) VALUES (?, ?, ?)",
+            (user_id, token, expires_at)
+        )
     
+    cache_token(token, user_id, expires_at)
     return token
 
+def cache_token(token: str, user_id: int, expires_at: int):
+    """Remember a valid token, dropping expired (then oldest) entries when full."""
+    with _token_cache_lock:
+        if len(_token_cache) >= TOKEN_CACHE_MAX_SIZE:
+            now = time.time()
+            for cached in [t for t, (_, exp) in _token_cache.items() if exp <= now]:
+                del _token_cache[cached]
+            while len(_token_cache) >= TOKEN_CACHE_MAX_SIZE:
+                del _token_cache[next(iter(_token_cache))]
+        _token_cache[token] = (user_id, expires_at)
+
 def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)) -> int:
     """Verify access token and return user_id."""
     token = credentials.credentials
+    now = int(time.time())
     
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT user_id FROM tokens WHERE token = ? AND expires_at > ?",
-        (token, datetime.utcnow())
-    )
-    result = cursor.fetchone()
-    conn.close()
+    cached = _token_cache.get(token)
+    if cached and cached[1] > now:
+        return cached[0]
+    
+    # The planner would otherwise pick the UNIQUE(token) index and then read
+    # the table row; idx_tokens_token_expires answers the whole query
+    with get_conn() as conn:
+        result = conn.execute(
+            """SELECT user_id, expires_at FROM tokens INDEXED BY idx_tokens_token_expires
+               WHERE token = ? AND expires_at > ?""",
+            (token, now)
+        ).fetchone()
     
     if not result:
         raise HTTPException(status_code=401, detail="Invalid or expired token")
     
+    user_id, expires_at = result
+    cache_token(token, user_id, expires_at)
+    return user_id
+
+def insert_document(
+    unique_id: str,
+    user_id: int,
+    filename: str,
+    pdf_path: str,
+    content_hash: str,
+    scan_limit: int,
+    security_metadata: dict
+):
+    """Insert a newly uploaded document and its security metadata."""
+    with get_conn() as conn:
+        conn.execute(
+            """INSERT INTO documents (unique_id, user_id, filename, pdf_data, pdf_path, content_hash, scan_limit,
+                                      ghost_pattern, frequency_signature, fingerprint_hash, security_version)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            # pdf_data is only populated for rows created before pdf_path existed
+            (unique_id, user_id, filename, b"", pdf_path, content_hash, scan_limit,
+             json.dumps(security_metadata['ghost_pattern']),
+             json.dumps(security_metadata['watermark_signature']),
+             security_metadata['fingerprint_hash'],
+             security_metadata['security_version'])
+        )
+
+def create_user(email: str, password_hash: str):
+    """Insert a new user (raises sqlite3.IntegrityError if the email is taken)."""
+    with get_conn() as conn:
+        conn.execute(
+            "INSERT INTO users (email, password_hash) VALUES (?, ?)",
+            (email, password_hash)
+        )
+
+def get_user_credentials(email: str) -> Optional[Tuple[int, str]]:
+    """Return (user_id, password_hash) for an email, or None."""
+    with get_conn() as conn:
+        return conn.execute(
+            "SELECT id, password_hash FROM users WHERE email = ?",
+            (email,)
+        ).fetchone()
+
+def update_password_hash(user_id: int, password_hash: str):
+    """Replace a user's stored password hash."""
+    with get_conn() as conn:
+        conn.execute(
+            "UPDATE users SET password_hash = ? WHERE id = ?",
+            (password_hash, user_id)
+        )
+
+def get_document(unique_id: str) -> Tuple[int, int, str, int, int]:
+    """Return (id, user_id, filename, scan_limit, scan_count) for a document, or raise 404."""
+    with get_conn() as conn:
+        result = conn.execute(
+            """SELECT id, user_id, filename, scan_limit, scan_count
+               FROM documents WHERE unique_id = ?""",
+            (unique_id,)
+        ).fetchone()
+    
+    if not result:
+        raise HTTPException(status_code=404, detail="Document not found")
+    
+    return result
+
+def get_pdf_location(unique_id: str) -> Tuple[Optional[str], Optional[bytes]]:
+    """Return (pdf_path, pdf_data) for a document, or raise 404."""
+    with get_conn() as conn:
+        result = conn.execute(
+            "SELECT pdf_path, pdf_data FROM documents WHERE unique_id = ?",
+            (unique_id,)
+        ).fetchone()
+    
+    if not result:
+        raise HTTPException(status_code=404, detail="Document not found")
+    
+    return result
+
+def claim_scan(unique_id: str, user_id: int) -> Tuple[str, Optional[str], Optional[bytes], int, int]:
+    """
+    Use up one scan of a document owned by user_id.
+    
+    Returns (filename, pdf_path, pdf_data, scan_limit, scan_count) with the
+    incremented scan_count, or raises 404/403/410.
+    """
+    with get_conn() as conn:
+        # Ownership check, limit check and increment in one atomic statement;
+        # fetchall() runs it to completion so the write lock is released here
+        result = conn.execute(
+            """UPDATE documents SET scan_count = scan_count + 1
+               WHERE unique_id = ? AND user_id = ? AND scan_count < scan_limit
+               RETURNING filename, pdf_path, pdf_data, scan_limit, scan_count""",
+            (unique_id, user_id)
+        ).fetchall()
+        
+        if not result:
+            raise_scan_denied(conn, unique_id, user_id)
+    
+    return result[0]
+
+def create_download_token(unique_id: str) -> str:
+    """Issue a single-use download token for a document."""
+    token = secrets.token_urlsafe(32)
+    
+    with get_conn() as conn:
+        conn.execute(
+            "INSERT INTO download_tokens (token, unique_id, expires_at) VALUES (?, ?, ?)",
+            (token, unique_id, int(time.time()) + DOWNLOAD_TOKEN_TTL_SECONDS)
+        )
+    
+    return token
+
+def redeem_download_token(token: str) -> Tuple[str, Optional[str], Optional[bytes], int, int]:
+    """
+    Redeem a download token, using up the scan it was issued for.
+    
+    Returns (filename, pdf_path, pdf_data, scan_limit, scan_count) with the
+    incremented scan_count. Raises 404 for unknown or used tokens and missing
+    files, 410 for expired tokens or an exhausted scan limit. The token and the
+    scan are only used up together, once the PDF is known to be sendable.
+    """
+    with get_conn() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        token_row = conn.execute(
+            "DELETE FROM download_tokens WHERE token = ? RETURNING unique_id, expires_at",
+            (token,)
+        ).fetchall()
+        
+        if not token_row:
+            raise HTTPException(status_code=404, detail="Download link is invalid or has already been used")
+        
+        unique_id, expires_at = token_row[0]
+        
+        if expires_at <= int(time.time()):
+            conn.execute("COMMIT")
+            raise HTTPException(status_code=410, detail="Download link has expired")
+        
+        result = conn.execute(
+            """UPDATE documents SET scan_count = scan_count + 1
+               WHERE unique_id = ? AND scan_count < scan_limit
+               RETURNING filename, pdf_path, pdf_data, scan_limit, scan_count""",
+            (unique_id,)
+        ).fetchall()
+        
+        if not result:
+            document = conn.execute(
+                "SELECT scan_limit, scan_count FROM documents WHERE unique_id = ?",
+                (unique_id,)
+            ).fetchone()
+            conn.execute("COMMIT")
+            
+            if not document:
+                raise HTTPException(status_code=404, detail="Document not found")
+            
+            scan_limit, scan_count = document
+            raise HTTPException(
+                status_code=410,
+                detail=f"Scan limit exceeded ({scan_count}/{scan_limit})"
+            )
+        
+        pdf_path = result[0][1]
+        
+        # Leaving the block without COMMIT rolls back, so a missing file uses up
+        # neither the link nor the scan
+        if pdf_path and not os.path.isfile(pdf_path):
+            raise HTTPException(status_code=404, detail="PDF file not found")
+        
+        conn.execute("COMMIT")
+    
     return result[0]
 
+def count_users_and_documents() -> Tuple[int, int]:
+    """Return (user count, document count)."""
+    with get_conn() as conn:
+        return conn.execute(
+            "SELECT (SELECT COUNT(*) FROM users), (SELECT COUNT(*) FROM documents)"
+        ).fetchone()
+
+def raise_scan_denied(conn: sqlite3.Connection, unique_id: str, user_id: int):
+    """Raise the right HTTP error after a conditional scan-count increment matched no row."""
+    result = conn.execute(
+        "SELECT user_id, scan_limit, scan_count FROM documents WHERE unique_id = ?",
+        (unique_id,)
+    ).fetchone()
+    
+    if not result:
+        raise HTTPException(status_code=404, detail="Document not found")
+    
+    doc_user_id, scan_limit, scan_count = result
+    
+    # Verify user owns this document
+    if doc_user_id != user_id:
+        raise HTTPException(status_code=403, detail="Access denied")
+    
+    raise HTTPException(
+        status_code=410,
+        detail=f"Scan limit exceeded ({scan_count}/{scan_limit})"
+    )
+
 # API Endpoints
 
 @app.post("/register")
 async def register(request: LoginRequest):
     """Register a new user."""
-    password_hash = hash_password(request.password)
+    password_hash = await asyncio.to_thread(hash_password, request.password)
     
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO users (email, password_hash) VALUES (?, ?)",
-            (request.email, password_hash)
-        )
-        conn.commit()
-        conn.close()
+        await asyncio.to_thread(create_user, request.email, password_hash)
         
         return {"message": "User registered successfully", "email": request.email}
     except sqlite3.IntegrityError:
@@ -168,22 +623,20 @@ async def register(request: LoginRequest):
 @app.post("/login", response_model=LoginResponse)
 async def login(request: LoginRequest):
     """Login with email and password."""
-    password_hash = hash_password(request.password)
-    
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT id FROM users WHERE email = ? AND password_hash = ?",
-        (request.email, password_hash)
-    )
-    result = cursor.fetchone()
-    conn.close()
+    result = await asyncio.to_thread(get_user_credentials, request.email)
     
-    if not result:
+    # Key derivation is CPU-bound; keep it off the event loop
+    if not result or not await asyncio.to_thread(verify_password, request.password, result[1]):
         raise HTTPException(status_code=401, detail="Invalid email or password")
     
-    user_id = result[0]
-    access_token = create_access_token(user_id)
+    user_id, password_hash = result
+    
+    # Upgrade legacy hashes now that the plaintext is known to be correct
+    if password_needs_rehash(password_hash):
+        new_hash = await asyncio.to_thread(hash_password, request.password)
+        await asyncio.to_thread(update_password_hash, user_id, new_hash)
+    
+    access_token = await asyncio.to_thread(create_access_token, user_id)
     
     return LoginResponse(access_token=access_token)
 
@@ -205,63 +658,83 @@ async def upload_pdf(
         Document info with QR code URL
     """
     # Validate file type
-    if not file.filename.endswith('.pdf'):
+    if file_extension(file.filename) != '.pdf':
         raise HTTPException(status_code=400, detail="Only PDF files are allowed")
     
-    # Read PDF data
-    pdf_data = await file.read()
-    
     # Generate unique ID
     unique_id = secrets.token_urlsafe(16)
     
-    # Generate secure QR code with anti-counterfeiting features
-    base_url = os.getenv("BASE_URL", "http://127.0.0.1:8000")
-    verify_url = f"{base_url}/verify/{unique_id}"
-    qr_image_bytes, security_metadata = generate_secure_qr_code(verify_url, unique_id)
-    
-    # Save to database with security metadata
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        """INSERT INTO documents (unique_id, user_id, filename, pdf_data, scan_limit,
-                                  ghost_pattern, frequency_signature, fingerprint_hash, security_version)
-           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-        (unique_id, user_id, file.filename, pdf_data, scan_limit,
-         json.dumps(security_metadata['ghost_pattern']),
-         json.dumps(security_metadata['watermark_signature']),
-         security_metadata['fingerprint_hash'],
-         security_metadata['security_version'])
-    )
-    conn.commit()
-    conn.close()
-    
-    # Save QR code to file
-    qr_filename = f"qr_{unique_id}.png"
-    qr_path = os.path.join("qr_codes", qr_filename)
-    os.makedirs("qr_codes", exist_ok=True)
-    
-    with open(qr_path, "wb") as f:
-        f.write(qr_image_bytes)
-    
-    base_url = os.getenv("BASE_URL", "http://127.0.0.1:8000")
+    # Stream the upload to disk rather than reading it whole or storing a BLOB,
+    # hashing the content in the same pass
+    pdf_path = os.path.join(PDF_DIR, f"{unique_id}.pdf")
+    qr_path = os.path.join(QR_DIR, f"qr_{unique_id}.png")
+    content_hasher = hashlib.sha256()
+    try:
+        async with aiofiles.open(pdf_path, "wb") as f:
+            while chunk := await file.read(FILE_CHUNK_SIZE):
+                content_hasher.update(chunk)
+                await f.write(chunk)
+        
+        # Generate secure QR code with anti-counterfeiting features
+        verify_url = f"{BASE_URL}/verify/{unique_id}"
+        qr_image_bytes, security_metadata = await asyncio.to_thread(
+            generate_secure_qr_code, verify_url, unique_id
+        )
+        
+        # Save QR code to file
+        async with aiofiles.open(qr_path, "wb") as f:
+            await f.write(qr_image_bytes)
+        
+        # Save to database with security metadata (sqlite3 blocks, so off the event loop).
+        # This is the last step, so the row only exists once both files are written
+        await asyncio.to_thread(
+            insert_document, unique_id, user_id, file.filename, pdf_path,
+            content_hasher.hexdigest(), scan_limit, security_metadata
+        )
+    except Exception:
+        # Don't leave files behind that no document row points to. Cancellation
+        # (BaseException) is deliberately not caught: the insert thread can't be
+        # stopped and may still commit a row that needs these files
+        for path in (pdf_path, qr_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        raise
     
     return DocumentResponse(
         unique_id=unique_id,
         filename=file.filename,
         scan_limit=scan_limit,
         scan_count=0,
-        qr_url=f"{base_url}/qr/{unique_id}"
+        qr_url=f"{BASE_URL}/qr/{unique_id}"
     )
 
 @app.get("/qr/{unique_id}")
-async def get_qr_code(unique_id: str):
-    """Get QR code image for a document."""
-    qr_path = os.path.join("qr_codes", f"qr_{unique_id}.png")
+async def get_qr_code(unique_id: str, request: Request):
+    """Get QR code image for a document (304 if the client's copy is current)."""
+    qr_path = os.path.join(QR_DIR, f"qr_{unique_id}.png")
     
-    if not os.path.exists(qr_path):
+    try:
+        stat_result = await asyncio.to_thread(os.stat, qr_path)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="QR code not found")
     
-    return FileResponse(qr_path, media_type="image/png")
+    # FileResponse derives its ETag from the stat result without opening the file
+    response = FileResponse(
+        qr_path,
+        media_type="image/png",
+        stat_result=stat_result,
+        headers={"Cache-Control": QR_CACHE_CONTROL}
+    )
+    
+    # If-None-Match uses weak comparison, so a W/ prefix on either side is ignored
+    etag = response.headers["etag"]
+    client_etags = {weak_etag(tag) for tag in request.headers.get("if-none-match", "").split(",")}
+    if weak_etag(etag) in client_etags or "*" in client_etags:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": QR_CACHE_CONTROL})
+    
+    return response
 
 @app.get("/verify/{unique_id}")
 async def verify_and_get_pdf(
@@ -278,54 +751,16 @@ async def verify_and_get_pdf(
     Returns:
         PDF file if valid, error otherwise
     """
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # Get document info
-    cursor.execute(
-        """SELECT id, user_id, filename, pdf_data, scan_limit, scan_count 
-           FROM documents WHERE unique_id = ?""",
-        (unique_id,)
+    filename, pdf_path, pdf_data, scan_limit, scan_count = await asyncio.to_thread(
+        claim_scan, unique_id, user_id
     )
-    result = cursor.fetchone()
-    
-    if not result:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Document not found")
-    
-    doc_id, doc_user_id, filename, pdf_data, scan_limit, scan_count = result
     
-    # Verify user owns this document
-    if doc_user_id != user_id:
-        conn.close()
-        raise HTTPException(status_code=403, detail="Access denied")
-    
-    # Check scan limit
-    if scan_count >= scan_limit:
-        conn.close()
-        raise HTTPException(
-            status_code=410, 
-            detail=f"Scan limit exceeded ({scan_count}/{scan_limit})"
-        )
-    
-    # Increment scan count
-    cursor.execute(
-        "UPDATE documents SET scan_count = scan_count + 1 WHERE id = ?",
-        (doc_id,)
-    )
-    conn.commit()
-    conn.close()
+    headers = {
+        "X-Scan-Count": str(scan_count),
+        "X-Scan-Limit": str(scan_limit)
+    }
     
-    # Return PDF file
-    return Response(
-        content=pdf_data,
-        media_type="application/pdf",
-        headers={
-            "Content-Disposition": f'attachment; filename="{filename}"',
-            "X-Scan-Count": str(scan_count + 1),
-            "X-Scan-Limit": str(scan_limit)
-        }
-    )
+    return pdf_response(filename, pdf_path, pdf_data, headers)
 
 
 @app.post("/verify-secure/{unique_id}")
@@ -335,7 +770,7 @@ async def verify_secure_and_get_pdf(
     user_id: int = Depends(verify_token)
 ):
     """
-    Verify QR authenticity first, then return PDF only if authentic.
+    Verify QR authenticity first, then release the PDF only if authentic.
     
     This endpoint combines authenticity verification with PDF retrieval.
     Only AUTHENTIC QR codes will grant access to the PDF.
@@ -346,66 +781,34 @@ async def verify_secure_and_get_pdf(
         user_id: Authenticated user ID (from token)
         
     Returns:
-        JSON with verification results and PDF data if authentic
+        JSON with verification results and a PDF download link if authentic
     """
     # Get document and security metadata from database
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute(
-        """SELECT id, user_id, filename, pdf_data, scan_limit, scan_count,
-                  ghost_pattern, frequency_signature, fingerprint_hash, security_version
-           FROM documents WHERE unique_id = ?""",
-        (unique_id,)
+    _, doc_user_id, filename, scan_limit, scan_count = await asyncio.to_thread(
+        get_document, unique_id
     )
-    result = cursor.fetchone()
-    
-    if not result:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Document not found")
-    
-    (doc_id, doc_user_id, filename, pdf_data, scan_limit, scan_count,
-     ghost_pattern_json, freq_sig_json, fingerprint_hash, security_version) = result
     
     # Verify user owns this document
     if doc_user_id != user_id:
-        conn.close()
         raise HTTPException(status_code=403, detail="Access denied")
     
     # Check scan limit
     if scan_count >= scan_limit:
-        conn.close()
         raise HTTPException(
             status_code=410,
             detail=f"Scan limit exceeded ({scan_count}/{scan_limit})"
         )
     
-    # Parse security metadata
-    security_metadata = {
-        'ghost_pattern': json.loads(ghost_pattern_json) if ghost_pattern_json else {},
-        'watermark_signature': json.loads(freq_sig_json) if freq_sig_json else [],
-        'fingerprint_hash': fingerprint_hash or '',
-        'security_version': security_version or 1
-    }
+    security_metadata = await asyncio.to_thread(load_security_metadata, unique_id)
     
     # Read uploaded QR image
     image_bytes = await file.read()
     
-    # Verify authenticity
-    from PIL import Image
-    from io import BytesIO
-    import numpy as np
-    from counterfeit_detector import CounterfeitDetector
-    
-    img = Image.open(BytesIO(image_bytes))
-    img_array = np.array(img.convert('RGB'))
-    
-    detector = CounterfeitDetector()
-    verification_result = detector.verify_qr_authenticity(img_array, security_metadata)
+    # Verify authenticity off the event loop
+    verification_result = await verify_image_async(image_bytes, security_metadata)
     
     # Only allow access if AUTHENTIC
     if verification_result['verdict'] != 'AUTHENTIC':
-        conn.close()
         return {
             'success': False,
             'verdict': verification_result['verdict'],
@@ -415,16 +818,10 @@ async def verify_secure_and_get_pdf(
             'message': f"Access denied: QR code is {verification_result['verdict']}. Authenticity score: {verification_result['authenticity_score']}%"
         }
     
-    # Increment scan count only if authentic
-    cursor.execute(
-        "UPDATE documents SET scan_count = scan_count + 1 WHERE id = ?",
-        (doc_id,)
-    )
-    conn.commit()
-    conn.close()
-    
-    # Return success with PDF data
-    pdf_base64 = base64.b64encode(pdf_data).decode('utf-8')
+    # Hand out a short-lived single-use link instead of inlining the PDF. The scan
+    # is used up when the link is redeemed, so a failed or expired download
+    # costs nothing and the client can verify again
+    download_token = await asyncio.to_thread(create_download_token, unique_id)
     
     return {
         'success': True,
@@ -432,14 +829,40 @@ async def verify_secure_and_get_pdf(
         'authenticity_score': verification_result['authenticity_score'],
         'details': verification_result['details'],
         'warnings': verification_result['warnings'],
-        'pdf_data': pdf_base64,
+        'download_url': f"/download/{download_token}",
         'filename': filename,
-        'scan_count': scan_count + 1,
+        'scan_count': scan_count,
         'scan_limit': scan_limit,
         'timestamp': datetime.utcnow().isoformat() + 'Z'
     }
 
 
+@app.get("/download/{download_token}")
+async def download_pdf(download_token: str):
+    """
+    Download a PDF using a link issued by /verify-secure.
+    
+    The token is the credential: it is valid for DOWNLOAD_TOKEN_TTL_SECONDS and is
+    consumed by the first request that uses it, which also uses up one scan.
+    
+    Args:
+        download_token: Single-use token from the download_url
+    
+    Returns:
+        PDF file if the token is valid and a scan remains, error otherwise
+    """
+    filename, pdf_path, pdf_data, scan_limit, scan_count = await asyncio.to_thread(
+        redeem_download_token, download_token
+    )
+    
+    headers = {
+        "X-Scan-Count": str(scan_count),
+        "X-Scan-Limit": str(scan_limit)
+    }
+    
+    return pdf_response(filename, pdf_path, pdf_data, headers)
+
+
 @app.post("/verify-authenticity/{unique_id}")
 async def verify_qr_authenticity(
     unique_id: str,
@@ -461,56 +884,26 @@ async def verify_qr_authenticity(
         Detailed authenticity report with verdict and scores
     """
     # Validate file type
-    allowed_extensions = ['.png', '.jpg', '.jpeg', '.bmp', '.webp']
-    if not any(file.filename.lower().endswith(ext) for ext in allowed_extensions):
+    if file_extension(file.filename) not in ALLOWED_IMAGE_EXTENSIONS:
         raise HTTPException(
             status_code=400, 
-            detail=f"Invalid file type. Allowed: {', '.join(allowed_extensions)}"
+            detail=f"Invalid file type. Allowed: {', '.join(sorted(ALLOWED_IMAGE_EXTENSIONS))}"
         )
     
     # Get document and security metadata from database
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute(
-        """SELECT user_id, ghost_pattern, frequency_signature, fingerprint_hash, security_version
-           FROM documents WHERE unique_id = ?""",
-        (unique_id,)
-    )
-    result = cursor.fetchone()
-    conn.close()
-    
-    if not result:
-        raise HTTPException(status_code=404, detail="Document not found")
-    
-    doc_user_id, ghost_pattern_json, freq_sig_json, fingerprint_hash, security_version = result
+    _, doc_user_id, _, _, _ = await asyncio.to_thread(get_document, unique_id)
     
     # Verify user owns this document
     if doc_user_id != user_id:
         raise HTTPException(status_code=403, detail="Access denied")
     
-    # Parse security metadata
-    security_metadata = {
-        'ghost_pattern': json.loads(ghost_pattern_json) if ghost_pattern_json else {},
-        'watermark_signature': json.loads(freq_sig_json) if freq_sig_json else [],
-        'fingerprint_hash': fingerprint_hash or '',
-        'security_version': security_version or 1
-    }
+    security_metadata = await asyncio.to_thread(load_security_metadata, unique_id)
     
     # Read uploaded image
     image_bytes = await file.read()
     
-    # Verify authenticity
-    from PIL import Image
-    from io import BytesIO
-    import numpy as np
-    
-    img = Image.open(BytesIO(image_bytes))
-    img_array = np.array(img.convert('RGB'))
-    
-    from counterfeit_detector import CounterfeitDetector
-    detector = CounterfeitDetector()
-    verification_result = detector.verify_qr_authenticity(img_array, security_metadata)
+    # Verify authenticity off the event loop
+    verification_result = await verify_image_async(image_bytes, security_metadata)
     
     # Add timestamp
     verification_result['timestamp'] = datetime.utcnow().isoformat() + 'Z'
@@ -527,16 +920,7 @@ async def root():
 @app.get("/health")
 async def health_check():
     """Health check endpoint."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT COUNT(*) FROM users")
-    user_count = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT COUNT(*) FROM documents")
-    doc_count = cursor.fetchone()[0]
-    
-    conn.close()
+    user_count, doc_count = await asyncio.to_thread(count_users_and_documents)
     
     return {
         "status": "healthy",
@@ -549,32 +933,24 @@ async def stamp_pdf(
     unique_id: str,
     user_id: int = Depends(verify_token)
 ):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
     # Fetch PDF data
-    cursor.execute(
-        "SELECT pdf_data FROM documents WHERE unique_id = ?", 
-        (unique_id,)
-    )
-    result = cursor.fetchone()
-    conn.close()
-    
-    if not result:
-        raise HTTPException(status_code=404, detail="Document not found")
-        
-    pdf_data_bytes = result[0]
+    pdf_data_bytes = await read_pdf(*await asyncio.to_thread(get_pdf_location, unique_id))
     
     if not pdf_data_bytes:
         raise HTTPException(status_code=404, detail="PDF content not found")
         
     try:
-        # Re-generate QR code image
-        verify_url = f"{os.getenv('BASE_URL', 'http://localhost:8000')}/verify/{unique_id}"
-        qr_img_bytes, _ = generate_secure_qr_code(verify_url, unique_id)
+        # Generation is deterministic per document, so reuse the QR written at
+        # upload and only re-generate it if the file is missing
+        try:
+            async with aiofiles.open(os.path.join(QR_DIR, f"qr_{unique_id}.png"), "rb") as f:
+                qr_img_bytes = await f.read()
+        except FileNotFoundError:
+            verify_url = f"{BASE_URL}/verify/{unique_id}"
+            qr_img_bytes, _ = await asyncio.to_thread(generate_secure_qr_code, verify_url, unique_id)
         
-        # Stamp it
-        stamped_pdf_bytes = stamp_pdf_with_qr(pdf_data_bytes, qr_img_bytes)
+        # Stamp it (CPU-bound, runs in the stamping process pool)
+        stamped_pdf_bytes = await stamp_pdf_with_qr_async(pdf_data_bytes, qr_img_bytes)
         
         # Return as downloadable file
         return Response(
@@ -591,14 +967,14 @@ async def stamp_pdf(
 async def verify_pdf_upload(
     file: UploadFile = File(...)
 ):
-    if not file.filename.lower().endswith('.pdf'):
+    if file_extension(file.filename) != '.pdf':
         raise HTTPException(status_code=400, detail="File must be a PDF")
         
     try:
         content = await file.read()
         
-        # 1. Extract QR code
-        qr_image, decoded_text = extract_qr_from_pdf(content)
+        # 1. Extract QR code (PDF parsing and rendering run in a worker thread)
+        qr_image, decoded_text = await asyncio.to_thread(extract_qr_from_pdf, content)
         
         if qr_image is None or decoded_text is None:
             return {
@@ -610,7 +986,6 @@ async def verify_pdf_upload(
             }
             
         # 2. Extract unique ID from decoded text
-        import re
         match = re.search(r'/verify/([^/?]+)', decoded_text)
         if not match:
              return {
@@ -624,21 +999,9 @@ async def verify_pdf_upload(
         unique_id = match.group(1)
             
         # 3. Verify authenticity using the extracted QR image
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        security_metadata = await asyncio.to_thread(load_security_metadata, unique_id)
         
-        cursor.execute(
-            """
-            SELECT ghost_pattern, frequency_signature, fingerprint_hash 
-            FROM documents WHERE unique_id = ?
-            """,
-            (unique_id,)
-        )
-        row = cursor.fetchone()
-        conn.close()
-        
-        if not row:
+        if security_metadata is None:
              return {
                 "success": False,
                 "verdict": "UNKNOWN_ID",
@@ -647,18 +1010,10 @@ async def verify_pdf_upload(
                 "warnings": ["Document ID not found in database"]
             }
             
-        # Reconstruct metadata dict
-        security_metadata = {
-            'ghost_pattern': json.loads(row['ghost_pattern']) if row['ghost_pattern'] else {},
-            'watermark_signature': json.loads(row['frequency_signature']) if row['frequency_signature'] else [],
-            'fingerprint_hash': row['fingerprint_hash'],
-            'image_size': None
-        }
-        
         # Note: qr_image is a numpy array (RGB)
-        from counterfeit_detector import CounterfeitDetector
-        detector = CounterfeitDetector()
-        verification_result = detector.verify_qr_authenticity(qr_image, security_metadata)
+        verification_result = await asyncio.to_thread(
+            get_detector().verify_qr_authenticity, qr_image, security_metadata
+        )
         
         # Add the unique_id to the result so frontend knows
         verification_result['unique_id'] = unique_id
@@ -1,17 +1,44 @@
 
 import io
+import asyncio
+import multiprocessing
 import cv2
 import numpy as np
 from PIL import Image
-from pypdf import PdfReader, PdfWriter, PageObject
+from pypdf import PdfReader, PageObject
 import tempfile
+import threading
 import os
-from pdf2image import convert_from_bytes
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import pymupdf
 from typing import Optional, Tuple, List
 
+# cv2.QRCodeDetector instances are reused, one per thread, since
+# extraction runs concurrently in worker threads
+_detector_local = threading.local()
+
+# Page render resolutions tried in order by the rendering fallback
+RENDER_DPIS = (150, 300)
+
+# Shared pool for QR detection on rendered pages (OpenCV releases the GIL)
+_DETECT_WORKERS = min(4, os.cpu_count() or 1)
+_DETECT_POOL = ThreadPoolExecutor(max_workers=_DETECT_WORKERS, thread_name_prefix="qr-detect")
+
+# Process pool for stamping, created on first use (see stamp_pdf_with_qr_async)
+_stamp_executor: Optional[ProcessPoolExecutor] = None
+_stamp_executor_lock = threading.Lock()
+
+def _get_qr_detector() -> cv2.QRCodeDetector:
+    """Return this thread's cached QR code detector."""
+    detector = getattr(_detector_local, 'detector', None)
+    if detector is None:
+        detector = _detector_local.detector = cv2.QRCodeDetector()
+    return detector
+
 def stamp_pdf_with_qr(pdf_bytes: bytes, qr_image_bytes: bytes) -> bytes:
     """
-    Overlay the QR code onto the last page of the PDF using ReportLab.
+    Stamp the QR code onto the last page of the PDF using PyMuPDF.
     
     Args:
         pdf_bytes: Original PDF file bytes
@@ -20,70 +47,217 @@ def stamp_pdf_with_qr(pdf_bytes: bytes, qr_image_bytes: bytes) -> bytes:
     Returns:
         Modified PDF bytes with QR stamped on last page
     """
-    from reportlab.pdfgen import canvas
-    from reportlab.lib.utils import ImageReader
+    # Open original PDF
+    with pymupdf.open(stream=pdf_bytes, filetype="pdf") as doc:
+        if doc.page_count == 0:
+            return pdf_bytes
+            
+        # Get the last page
+        last_page = doc[-1]
+        page_rect = last_page.rect
+        
+        # QR Code Settings
+        qr_display_size = 100  # 100 points (approx 1.4 inches)
+        margin = 20
+        
+        # Position: Bottom Right
+        # PyMuPDF uses a top-left origin, so the bottom margin is measured from page height
+        rect = pymupdf.Rect(
+            page_rect.width - qr_display_size - margin,
+            page_rect.height - qr_display_size - margin,
+            page_rect.width - margin,
+            page_rect.height - margin,
+        )
+        
+        # Draw QR code
+        # CRITICAL: Do NOT resize the image itself (e.g. img.resize()).
+        # Resizing destroys the pixel-perfect steganography (ghost dots, watermarks).
+        # The original full-resolution PNG is embedded as-is and only displayed
+        # at the smaller size, which preserves the underlying pixel data in the PDF object.
+        last_page.insert_image(rect, stream=qr_image_bytes, keep_proportion=True)
+        
+        # Write output (single serialization pass, no overlay PDF to merge).
+        # PyMuPDF stores the inserted pixels uncompressed, so deflate them losslessly.
+        return doc.tobytes(deflate=True)
+
+def _get_stamp_executor() -> ProcessPoolExecutor:
+    """Return the shared stamping process pool, starting it on first use."""
+    global _stamp_executor
+    with _stamp_executor_lock:
+        if _stamp_executor is None:
+            # 'spawn' rather than fork: the parent runs thread pools and an
+            # event loop, which must not be duplicated mid-flight into children
+            _stamp_executor = ProcessPoolExecutor(
+                max_workers=os.cpu_count(),
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _stamp_executor
+
+async def stamp_pdf_with_qr_async(pdf_bytes: bytes, qr_image_bytes: bytes) -> bytes:
+    """
+    Run stamp_pdf_with_qr in a worker process without blocking the event loop.
     
-    # Read original PDF
-    reader = PdfReader(io.BytesIO(pdf_bytes))
-    writer = PdfWriter()
+    Stamping is CPU-bound and PyMuPDF holds the GIL while it works, so it runs
+    in a separate process rather than a thread.
     
-    if len(reader.pages) == 0:
-        return pdf_bytes
-        
-    # Copy all pages
-    for page in reader.pages:
-        writer.add_page(page)
+    Args:
+        pdf_bytes: Original PDF file bytes
+        qr_image_bytes: QR code image bytes
         
-    # Get the last page
-    last_page = writer.pages[-1]
+    Returns:
+        Modified PDF bytes with QR stamped on last page
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_stamp_executor(), stamp_pdf_with_qr, pdf_bytes, qr_image_bytes)
+
+def shutdown_stamp_executor() -> None:
+    """Stop the stamping process pool, if it was started."""
+    global _stamp_executor
+    with _stamp_executor_lock:
+        if _stamp_executor is not None:
+            _stamp_executor.shutdown(cancel_futures=True)
+            _stamp_executor = None
+
+def _is_qr_sized_image(img_obj) -> bool:
+    """
+    Cheap pre-filter on an image XObject's dictionary (no stream decoding).
     
-    # Get page dimensions
+    Our stamped QR codes are square and embedded at full resolution, so
+    anything tiny or strongly non-square can be skipped.
+    
+    Args:
+        img_obj: pypdf image XObject
+        
+    Returns:
+        True if the image is worth decoding and scanning for a QR code
+    """
     try:
-        page_width = float(last_page.mediabox.width)
-        page_height = float(last_page.mediabox.height)
-    except:
-        page_width, page_height = 595, 842
+        width = int(img_obj.get('/Width', 0))
+        height = int(img_obj.get('/Height', 0))
+    except (TypeError, ValueError):
+        return False
         
-    # Prepare QR image
-    # CRITICAL: Do NOT resize the PIL image itself (e.g. img.resize()).
-    # Resizing destroys the pixel-perfect steganography (ghost dots, watermarks).
-    # Instead, we serve the original full-resolution image to ReportLab and tell 
-    # ReportLab to display it at a smaller size (scaling).
-    qr_image = Image.open(io.BytesIO(qr_image_bytes))
+    if min(width, height) < 100:
+        return False
+    return max(width, height) <= 2 * min(width, height)
+
+def _color_space_channels(color_space) -> Optional[int]:
+    """
+    Number of components for a plain RGB/gray image color space.
     
-    # Create the overlay PDF in memory
-    packet = io.BytesIO()
-    c = canvas.Canvas(packet, pagesize=(page_width, page_height))
+    Args:
+        color_space: /ColorSpace entry of an image XObject
+        
+    Returns:
+        3 or 1, or None for anything else (indexed, CMYK, ...)
+    """
+    if color_space == '/DeviceRGB':
+        return 3
+    if color_space == '/DeviceGray':
+        return 1
     
-    # QR Code Settings
-    qr_display_size = 100  # 100 points (approx 1.4 inches)
-    margin = 20
+    # [/ICCBased <<stream with /N>>] as written by PyMuPDF
+    color_space = color_space.get_object() if color_space is not None else None
+    if isinstance(color_space, list) and len(color_space) == 2 and color_space[0] == '/ICCBased':
+        components = color_space[1].get_object().get('/N')
+        if components in (1, 3):
+            return int(components)
+    return None
+
+def _image_xobject_to_rgb(img_obj) -> Optional[np.ndarray]:
+    """
+    Decode an image XObject into an RGB numpy array.
     
-    # Position: Bottom Right
-    # (0,0) is bottom-left
-    x = page_width - qr_display_size - margin
-    y = margin # Bottom margin
+    JPEG (/DCTDecode) streams are opened by PIL as-is. Flate-compressed
+    8-bit RGB/gray streams (how our stamped QR codes are embedded) hold raw
+    pixels, which are reshaped directly from the buffer.
     
-    # Draw QR code
-    # We pass the original full-res image. ReportLab scales it to fit (width, height)
-    # This preserves the underlying pixel data in the PDF object.
-    c.drawImage(ImageReader(qr_image), x, y, width=qr_display_size, height=qr_display_size, mask='auto', preserveAspectRatio=True)
+    Args:
+        img_obj: pypdf image XObject
+        
+    Returns:
+        RGB image array, or None if the encoding isn't supported
+    """
+    filters = img_obj.get('/Filter')
+    if not isinstance(filters, list):
+        filters = [filters] if filters is not None else []
+    last_filter = filters[-1] if filters else None
     
-    c.save()
-    packet.seek(0)
+    data = img_obj.get_data()
     
-    # Merge overlay
-    overlay_reader = PdfReader(packet)
-    overlay_page = overlay_reader.pages[0]
+    if last_filter in (None, '/FlateDecode') and img_obj.get('/BitsPerComponent') == 8:
+        width, height = int(img_obj['/Width']), int(img_obj['/Height'])
+        channels = _color_space_channels(img_obj.get('/ColorSpace'))
+        if channels and len(data) == width * height * channels:
+            pixels = np.frombuffer(data, dtype=np.uint8).reshape(height, width, channels)
+            if channels == 1:
+                return cv2.cvtColor(pixels, cv2.COLOR_GRAY2RGB)
+            return pixels
+            
+    # Otherwise rely on PIL to open the data as an image file (e.g. JPEG)
+    try:
+        pil_image = Image.open(io.BytesIO(data))
+    except Exception:
+        return None
+        
+    # Only convert when the mode needs it; convert('RGB') copies even for RGB input
+    if pil_image.mode == 'RGB':
+        return np.asarray(pil_image)
+    if pil_image.mode == 'L':
+        return cv2.cvtColor(np.asarray(pil_image), cv2.COLOR_GRAY2RGB)
+    return np.asarray(pil_image.convert('RGB'))
+
+def _render_page_gray(page, dpi: int) -> np.ndarray:
+    """
+    Render one PDF page to a grayscale numpy array.
     
-    last_page.merge_page(overlay_page)
+    Args:
+        page: PyMuPDF page
+        dpi: Render resolution
+        
+    Returns:
+        uint8 array of shape (height, width)
+    """
+    # The detector works on grayscale, so render straight to one channel
+    pix = page.get_pixmap(dpi=dpi, colorspace=pymupdf.csGRAY, alpha=False)
+    return np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width)
+
+def _scan_rendered_page(gray: np.ndarray) -> Tuple[Optional[np.ndarray], Optional[str]]:
+    """
+    Look for a QR code on a rendered page.
+    
+    The bottom-right corner (where stamp_pdf_with_qr places the QR) is
+    searched first, since the detector is much faster on a small crop;
+    the whole page is only searched if that fails. Safe to call from
+    worker threads.
+    
+    Args:
+        gray: Grayscale page render
+        
+    Returns:
+        Tuple (straightened_qr_rgb_array, decoded_text) or (None, None)
+    """
+    detector = _get_qr_detector()
     
-    # Write output
-    output_buffer = io.BytesIO()
-    writer.write(output_buffer)
-    output_buffer.getvalue()
+    height, width = gray.shape
+    roi = gray[int(height * 0.75):, int(width * 0.65):]
     
-    return output_buffer.getvalue()
+    for candidate in (roi, gray):
+        decoded_text, points, straight_qrcode = detector.detectAndDecode(candidate)
+        
+        if decoded_text:
+            if straight_qrcode is not None:
+                if len(straight_qrcode.shape) == 2:
+                    straight_qrcode = cv2.cvtColor(straight_qrcode, cv2.COLOR_GRAY2RGB)
+                elif straight_qrcode.shape[2] == 4:
+                    straight_qrcode = cv2.cvtColor(straight_qrcode, cv2.COLOR_BGRA2RGB)
+                else:
+                    straight_qrcode = cv2.cvtColor(straight_qrcode, cv2.COLOR_BGR2RGB)
+                    
+                return straight_qrcode, decoded_text
+            break
+            
+    return None, None
 
 def extract_qr_from_pdf(pdf_bytes: bytes) -> Tuple[Optional[np.ndarray], Optional[str]]:
     """
@@ -99,83 +273,90 @@ def extract_qr_from_pdf(pdf_bytes: bytes) -> Tuple[Optional[np.ndarray], Optiona
     Returns:
         Tuple (cropped_qr_numpy_array, decoded_text) or (None, None) if not found
     """
-    detector = cv2.QRCodeDetector()
+    detector = _get_qr_detector()
     
     # Strategy 1: Direct Image Extraction (Best for digital verification)
     try:
         reader = PdfReader(io.BytesIO(pdf_bytes))
+        visited = set()  # XObjects shared between pages are only inspected once
         for page in reader.pages:
             if '/XObject' in page['/Resources']:
                 xObject = page['/Resources']['/XObject'].get_object()
                 for obj in xObject:
-                    if xObject[obj]['/Subtype'] == '/Image':
-                        try:
-                            # Extract raw image bytes
-                            img_obj = xObject[obj]
-                            data = img_obj.get_data()
-                            
-                            # Convert to PIL Image
-                            # Note: handle different filters/color spaces if needed
-                            # pypdf's get_data() usually handles simple cases well
-                            
-                            # We'll rely on PIL to open the raw data if possible,
-                            # or reconstruct from bytes if it's raw pixel data.
-                            # pypdf images can be complex. simpler to use PIL on extracted bytes if robust.
-                            # Let's try simple PIL open first.
-                            try:
-                                pil_image = Image.open(io.BytesIO(data))
-                            except:
-                                # Sometimes data is raw pixels, not a file format.
-                                # pypdf helper might be needed.
-                                continue
-                                
-                            # Convert to numpy/opencv
-                            cv_image = np.array(pil_image.convert('RGB'))
-                            cv_image = cv_image[:, :, ::-1].copy() # RGB to BGR
+                    img_obj = xObject[obj]
+                    if img_obj.get('/Subtype') != '/Image':
+                        continue
+                        
+                    ref = img_obj.indirect_reference
+                    if ref is not None:
+                        if ref.idnum in visited:
+                            continue
+                        visited.add(ref.idnum)
+                        
+                    # Peek at the dictionary before decoding the stream so
+                    # photos, logos and other non-QR images are never inflated.
+                    if not _is_qr_sized_image(img_obj):
+                        continue
+                        
+                    try:
+                        rgb_image = _image_xobject_to_rgb(img_obj)
+                        if rgb_image is None:
+                            continue
                             
-                            # Detect
-                            decoded_text, points, straight_qrcode = detector.detectAndDecode(cv_image)
+                        # Detect (the detector works on grayscale internally)
+                        gray = cv2.cvtColor(rgb_image, cv2.COLOR_RGB2GRAY)
+                        decoded_text, points, straight_qrcode = detector.detectAndDecode(gray)
+                        
+                        if decoded_text:
+                            # For direct extraction, verify the ORIGINAL image, not the crop
+                            # straight_qrcode is a re-sampled crop.
+                            # The verification logic prefers the original input if it's a pure QR code image.
+                            # If the extracted image contains JUST the QR code (which it should for our stamped PDFs),
+                            # we should return the whole image to preserve steganography.
+                            return rgb_image, decoded_text
                             
-                            if decoded_text:
-                                # For direct extraction, verify the ORIGINAL image, not the crop
-                                # straight_qrcode is a re-sampled crop.
-                                # The verification logic prefers the original input if it's a pure QR code image.
-                                # If the extracted image contains JUST the QR code (which it should for our stamped PDFs),
-                                # we should return the whole image to preserve steganography.
-                                
-                                # Convert back to RGB
-                                rgb_result = cv2.cvtColor(cv_image, cv2.COLOR_BGR2RGB)
-                                return rgb_result, decoded_text
-                                
-                        except Exception as e:
-                            print(f"Failed to process embedded image: {e}")
-                            continue
+                    except Exception as e:
+                        print(f"Failed to process embedded image: {e}")
+                        continue
     except Exception as e:
         print(f"Direct extraction failed: {e}")
 
     # Strategy 2: Render Page (Fallback)
+    # PyMuPDF renders in-process, one page at a time, straight into a
+    # pixel buffer (no Poppler subprocess or intermediate PPM files).
     try:
-        # Higher DPI for better quality
-        images = convert_from_bytes(pdf_bytes, dpi=300)
+        doc = pymupdf.open(stream=pdf_bytes, filetype="pdf")
     except Exception as e:
-        print(f"Error converting PDF to images: {e}")
+        print(f"Error opening PDF for rendering: {e}")
         return None, None
         
-    for i, pil_image in enumerate(images):
-        cv_image = np.array(pil_image)
-        cv_image = cv_image[:, :, ::-1].copy()
-        
-        decoded_text, points, straight_qrcode = detector.detectAndDecode(cv_image)
-        
-        if decoded_text:
-            if straight_qrcode is not None:
-                if len(straight_qrcode.shape) == 2:
-                    straight_qrcode = cv2.cvtColor(straight_qrcode, cv2.COLOR_GRAY2RGB)
-                elif straight_qrcode.shape[2] == 4:
-                    straight_qrcode = cv2.cvtColor(straight_qrcode, cv2.COLOR_BGRA2RGB)
-                else:
-                    straight_qrcode = cv2.cvtColor(straight_qrcode, cv2.COLOR_BGR2RGB)
-                    
-                return straight_qrcode, decoded_text
-            
+    with doc:
+        # Cheap low-resolution pass over every page first; re-render at
+        # full resolution only if nothing was found
+        for dpi in RENDER_DPIS:
+            # PyMuPDF must stay on this thread, but detection runs in the
+            # pool so the next page renders while earlier ones are scanned.
+            # Results are still taken in page order.
+            pending = deque()
+            for page in doc:
+                pending.append(_DETECT_POOL.submit(_scan_rendered_page, _render_page_gray(page, dpi)))
+                
+                # Collect finished pages, and cap how many renders are in flight
+                while pending and (pending[0].done() or len(pending) >= _DETECT_WORKERS):
+                    straight_qrcode, decoded_text = pending.popleft().result()
+                    if decoded_text:
+                        _cancel_all(pending)
+                        return straight_qrcode, decoded_text
+                        
+            while pending:
+                straight_qrcode, decoded_text = pending.popleft().result()
+                if decoded_text:
+                    _cancel_all(pending)
+                    return straight_qrcode, decoded_text
+                
     return None, None
+
+def _cancel_all(futures) -> None:
+    """Cancel detection tasks that are no longer needed."""
+    for future in futures:
+        future.cancel()
@@ -7,15 +7,15 @@ This module implements multiple layers of security:
 3. Pixel Fingerprinting - Unique noise patterns
 """
 
+import base64
 import hashlib
 import json
-import random
 import numpy as np
 import cv2
 import qrcode
 from PIL import Image, ImageDraw
 from io import BytesIO
-from scipy.fftpack import dct, idct
+from scipy.fft import dctn, idctn
 from typing import Tuple, Dict, List
 
 
@@ -63,36 +63,41 @@ class SecureQRGenerator:
         # Convert to numpy array for processing
         img_array = np.array(pil_img.convert('RGB'))
         
+        # Hash the document ID once; every security layer derives its seed from this digest
+        seed_digest = hashlib.sha256(doc_id.encode()).digest()
+        
         # Step 2: Add ghost dots
-        ghost_pattern = self._embed_ghost_dots(img_array, doc_id)
+        ghost_pattern = self._embed_ghost_dots(img_array, seed_digest)
         
         # Step 3: Add frequency domain watermark
-        watermark_signature = self._embed_frequency_watermark(img_array, doc_id)
+        watermark_signature = self._embed_frequency_watermark(img_array, seed_digest)
         
         # Step 4: Add pixel fingerprint
-        fingerprint_hash = self._add_pixel_fingerprint(img_array, doc_id)
+        fingerprint_hash = self._add_pixel_fingerprint(img_array, seed_digest)
         
         # Convert back to PIL Image
         final_img = Image.fromarray(img_array)
         
         # Convert to bytes
         buffer = BytesIO()
-        final_img.save(buffer, format='PNG')
+        final_img.save(buffer, format='PNG', compress_level=1)  # fast zlib level; PNG stays lossless
         buffer.seek(0)
         image_bytes = buffer.getvalue()
         
         # Prepare security metadata
         security_metadata = {
             'ghost_pattern': ghost_pattern,
-            'watermark_signature': watermark_signature.tolist(),
+            # Raw little-endian float32 bytes, base64-encoded (version 1 stored nested lists)
+            'watermark_signature': base64.b64encode(watermark_signature.astype('<f4').tobytes()).decode('ascii'),
+            'watermark_shape': list(watermark_signature.shape),
             'fingerprint_hash': fingerprint_hash,
             'image_size': img_array.shape[:2],
-            'security_version': 1
+            'security_version': 2
         }
         
         return image_bytes, security_metadata
     
-    def _embed_ghost_dots(self, img_array: np.ndarray, seed: str) -> Dict:
+    def _embed_ghost_dots(self, img_array: np.ndarray, seed_digest: bytes) -> Dict:
         """
         Embed invisible ghost dots in white areas of the QR code.
         
@@ -101,7 +106,7 @@ class SecureQRGenerator:
         
         Args:
             img_array: QR code image as numpy array (modified in-place)
-            seed: Seed for random pattern generation
+            seed_digest: SHA-256 digest of the document ID
             
         Returns:
             Dictionary containing ghost dot pattern information
@@ -109,39 +114,77 @@ class SecureQRGenerator:
         height, width = img_array.shape[:2]
         
         # Create deterministic random generator from seed
-        rng = random.Random(seed)
+        rng = np.random.default_rng(int.from_bytes(seed_digest[:8], 'little'))
         
-        # Find white pixels (potential locations for ghost dots)
-        white_mask = np.all(img_array >= 250, axis=2)
-        white_coords = np.argwhere(white_mask)
+        # Select random white pixels (potential locations for ghost dots)
+        ghost_positions = self._sample_white_pixels(img_array, rng, self.ghost_dot_density)
         
-        if len(white_coords) == 0:
-            return {'coordinates': [], 'count': 0}
+        if len(ghost_positions) == 0:
+            return {'xs': [], 'ys': [], 'vals': [], 'count': 0}
         
-        # Select random positions for ghost dots
-        num_dots = min(self.ghost_dot_density, len(white_coords))
-        selected_indices = rng.sample(range(len(white_coords)), num_dots)
-        ghost_positions = white_coords[selected_indices]
+        num_dots = len(ghost_positions)
         
-        # Embed ghost dots with nearly invisible gray values
-        ghost_coords = []
-        for y, x in ghost_positions:
-            # Random gray value between 250-254 (nearly invisible)
-            gray_value = rng.randint(*self.ghost_dot_color_range)
-            img_array[y, x] = [gray_value, gray_value, gray_value]
-            ghost_coords.append({'x': int(x), 'y': int(y), 'value': gray_value})
+        # Embed ghost dots with nearly invisible gray values (250-254),
+        # all channels in a single vectorized store
+        low, high = self.ghost_dot_color_range
+        gray_values = rng.integers(low, high + 1, size=num_dots, dtype=np.uint8)
+        img_array[ghost_positions[:, 0], ghost_positions[:, 1], :] = gray_values[:, None]
         
-        # Create pattern hash for verification
-        pattern_str = json.dumps(sorted(ghost_coords, key=lambda d: (d['x'], d['y'])))
-        pattern_hash = hashlib.sha256(pattern_str.encode()).hexdigest()
+        # Create pattern hash for verification: rows of little-endian int32
+        # (x, y, value) sorted by x then y, so it's independent of platform and draw order
+        order = np.lexsort((ghost_positions[:, 0], ghost_positions[:, 1]))
+        payload = np.column_stack((
+            ghost_positions[order, 1], ghost_positions[order, 0], gray_values[order]
+        )).astype('<i4').tobytes()
+        pattern_hash = hashlib.sha256(payload).hexdigest()
         
         return {
-            'coordinates': ghost_coords,
+            # Parallel arrays (security_version 2); version 1 stored a list of
+            # {'x', 'y', 'value'} dicts under 'coordinates'
+            'xs': ghost_positions[:, 1].tolist(),
+            'ys': ghost_positions[:, 0].tolist(),
+            'vals': gray_values.tolist(),
             'count': num_dots,
             'pattern_hash': pattern_hash
         }
     
-    def _embed_frequency_watermark(self, img_array: np.ndarray, seed: str) -> np.ndarray:
+    def _sample_white_pixels(self, img_array: np.ndarray, rng: np.random.Generator, count: int) -> np.ndarray:
+        """
+        Pick up to `count` distinct random white pixels (all channels >= 250).
+        
+        QR codes are mostly white, so rejection-sampling random (y, x)
+        candidates finds enough positions while touching only a few hundred
+        pixels. Falls back to a full-image scan for unusually dark images.
+        
+        Args:
+            img_array: QR code image as numpy array
+            rng: Seeded random generator
+            count: Number of positions wanted
+            
+        Returns:
+            Array of shape (n, 2) with (y, x) positions, n <= count
+        """
+        height, width = img_array.shape[:2]
+        selected = np.empty((0, 2), dtype=np.intp)
+        
+        for _ in range(8):
+            ys = rng.integers(0, height, size=4 * count)
+            xs = rng.integers(0, width, size=4 * count)
+            is_white = np.all(img_array[ys, xs] >= 250, axis=1)
+            candidates = np.concatenate([selected, np.stack([ys[is_white], xs[is_white]], axis=1)])
+            
+            # Drop repeated positions, keeping first-drawn order
+            _, first = np.unique(candidates[:, 0] * width + candidates[:, 1], return_index=True)
+            selected = candidates[np.sort(first)]
+            if len(selected) >= count:
+                return selected[:count]
+        
+        # Too few white pixels to sample from; scan the whole image
+        white_coords = np.argwhere(np.all(img_array >= 250, axis=2))
+        num_dots = min(count, len(white_coords))
+        return white_coords[rng.choice(len(white_coords), size=num_dots, replace=False)]
+    
+    def _embed_frequency_watermark(self, img_array: np.ndarray, seed_digest: bytes) -> np.ndarray:
         """
         Embed a watermark in the frequency domain using DCT.
         
@@ -149,19 +192,24 @@ class SecureQRGenerator:
         
         Args:
             img_array: QR code image as numpy array (modified in-place)
-            seed: Seed for watermark generation
+            seed_digest: SHA-256 digest of the document ID
             
         Returns:
             Watermark signature array
         """
-        # Convert to grayscale for DCT
-        gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY).astype(float)
-        
-        # Apply DCT
-        dct_coeffs = dct(dct(gray.T, norm='ortho').T, norm='ortho')
-        
-        # Generate watermark signature from seed
-        rng = np.random.RandomState(int(hashlib.sha256(seed.encode()).hexdigest()[:8], 16))
+        # Convert to grayscale once; the blend below works from this buffer too
+        gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
+        
+        # Apply DCT (OpenCV's orthonormal DCT only supports even sizes)
+        use_cv2 = gray.shape[0] % 2 == 0 and gray.shape[1] % 2 == 0
+        if use_cv2:
+            dct_coeffs = cv2.dct(gray.astype(np.float32))
+        else:
+            dct_coeffs = dctn(gray.astype(float), norm='ortho', workers=-1)
+        
+        # Generate watermark signature from seed (first 4 digest bytes, big-endian,
+        # i.e. the first 8 hex digits)
+        rng = np.random.RandomState(int.from_bytes(seed_digest[:4], 'big'))
         signature = rng.randn(8, 8)  # 8x8 signature
         
         # Embed in mid-frequency coefficients (more robust)
@@ -171,18 +219,21 @@ class SecureQRGenerator:
         dct_coeffs[mid_h:mid_h+8, mid_w:mid_w+8] += signature * self.watermark_strength * np.abs(dct_coeffs[mid_h:mid_h+8, mid_w:mid_w+8]).mean()
         
         # Inverse DCT
-        watermarked = idct(idct(dct_coeffs.T, norm='ortho').T, norm='ortho')
+        if use_cv2:
+            watermarked = cv2.idct(dct_coeffs)
+        else:
+            watermarked = idctn(dct_coeffs, norm='ortho', workers=-1)
         watermarked = np.clip(watermarked, 0, 255).astype(np.uint8)
         
-        # Convert back to RGB
-        watermarked_rgb = cv2.cvtColor(watermarked, cv2.COLOR_GRAY2RGB)
-        
-        # Blend with original (preserve QR code readability)
-        img_array[:] = cv2.addWeighted(img_array, 0.7, watermarked_rgb, 0.3, 0)
+        # Blend with original (preserve QR code readability):
+        # 0.7 * img + 0.3 * watermarked == img + 0.3 * (watermarked - gray)
+        # for a gray image, so only the grayscale delta is broadcast into RGB
+        delta = np.rint(0.3 * (watermarked.astype(np.int16) - gray)).astype(np.int16)
+        img_array[:] = np.clip(img_array + delta[:, :, None], 0, 255).astype(np.uint8)
         
         return signature
     
-    def _add_pixel_fingerprint(self, img_array: np.ndarray, seed: str) -> str:
+    def _add_pixel_fingerprint(self, img_array: np.ndarray, seed_digest: bytes) -> str:
         """
         Add a unique noise-based fingerprint to specific pixels.
         
@@ -190,7 +241,7 @@ class SecureQRGenerator:
         
         Args:
             img_array: QR code image as numpy array (modified in-place)
-            seed: Seed for fingerprint generation
+            seed_digest: SHA-256 digest of the document ID
             
         Returns:
             Hash of the fingerprint pattern
@@ -198,30 +249,24 @@ class SecureQRGenerator:
         height, width = img_array.shape[:2]
         
         # Create deterministic random generator
-        rng = np.random.RandomState(int(hashlib.sha256(seed.encode()).hexdigest()[:8], 16))
+        rng = np.random.RandomState(int.from_bytes(seed_digest[:4], 'big'))
         
-        # Select specific pixels in a grid pattern
+        # Select specific pixels in a grid pattern (a strided view, no copy)
         step = 5  # Every 5th pixel
-        y_coords, x_coords = np.meshgrid(
-            range(step, height, step),
-            range(step, width, step),
-            indexing='ij'
-        )
+        grid = img_array[step:height:step, step:width:step]
         
-        # Generate noise pattern
-        num_pixels = len(y_coords.flatten())
+        # Generate noise pattern (drawn in the same row-major order as the grid)
         noise = rng.randint(-self.fingerprint_strength, self.fingerprint_strength + 1, 
-                           size=(num_pixels, 3))
+                           size=(grid.shape[0] * grid.shape[1], 3))
         
         # Apply noise to selected pixels
-        for idx, (y, x) in enumerate(zip(y_coords.flatten(), x_coords.flatten())):
-            img_array[y, x] = np.clip(img_array[y, x].astype(int) + noise[idx], 0, 255).astype(np.uint8)
+        grid[...] = np.clip(grid + noise.reshape(grid.shape), 0, 255).astype(np.uint8)
         
         # Create fingerprint hash
         fingerprint_data = {
             'step': step,
             'noise_strength': self.fingerprint_strength,
-            'seed_hash': hashlib.sha256(seed.encode()).hexdigest()
+            'seed_hash': seed_digest.hex()
         }
         fingerprint_str = json.dumps(fingerprint_data, sort_keys=True)
         fingerprint_hash = hashlib.sha256(fingerprint_str.encode()).hexdigest()
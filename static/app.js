@@ -547,7 +547,7 @@ async function verifyQRCodeSecure(uniqueId, qrImageFile) {
     }
 }
 
-function displaySecureScanSuccess(data) {
+async function displaySecureScanSuccess(data) {
     // Show in scan section
     document.getElementById('scanResult').style.display = 'block';
     document.getElementById('scanSuccess').style.display = 'block';
@@ -569,11 +569,23 @@ function displaySecureScanSuccess(data) {
     setBadgeStatus('scanFingerprintBadge', details.pixel_fingerprint.status);
     setBadgeStatus('scanMetadataBadge', details.metadata.status);
     
-    // Display PDF inline
-    const pdfData = data.pdf_data;
-    const pdfBlob = base64ToBlob(pdfData, 'application/pdf');
-    const pdfUrl = URL.createObjectURL(pdfBlob);
-    document.getElementById('pdfViewer').src = pdfUrl;
+    // Fetch the PDF through its single-use download link and display it inline
+    try {
+        const response = await fetch(`${API_BASE}${data.download_url}`);
+        if (!response.ok) {
+            const error = await response.json().catch(() => ({}));
+            showToast(error.detail || 'PDF download failed', 'error');
+            return;
+        }
+        
+        // The scan is used up when the link is redeemed
+        document.getElementById('scanUsedCount').textContent = response.headers.get('X-Scan-Count');
+        
+        currentPDFBlob = await response.blob();
+        document.getElementById('pdfViewer').src = URL.createObjectURL(currentPDFBlob);
+    } catch (error) {
+        showToast('Network error: ' + error.message, 'error');
+    }
 }
 
 function displaySecureScanError(data) {
@@ -618,16 +630,6 @@ function setBadgeStatus(badgeId, status) {
     badge.className = `security-badge badge-${status.toLowerCase()}`;
 }
 
-function base64ToBlob(base64, contentType) {
-    const byteCharacters = atob(base64);
-    const byteNumbers = new Array(byteCharacters.length);
-    for (let i = 0; i < byteCharacters.length; i++) {
-        byteNumbers[i] = byteCharacters.charCodeAt(i);
-    }
-    const byteArray = new Uint8Array(byteNumbers);
-    return new Blob([byteArray], { type: contentType });
-}
-
 function resetScan() {
     document.getElementById('scanResult').style.display = 'none';
     document.getElementById('scanUniqueId').value = '';
@@ -136,7 +136,7 @@ def main():
     
     print(f"\n✅ Secure QR code generated successfully!")
     print(f"   - Ghost dots: {security_metadata['ghost_pattern']['count']}")
-    print(f"   - Watermark signature: {len(security_metadata['watermark_signature'])} coefficients")
+    print(f"   - Watermark signature: {'x'.join(map(str, security_metadata['watermark_shape']))} coefficients")
     print(f"   - Fingerprint hash: {security_metadata['fingerprint_hash'][:16]}...")
     print(f"   - Security version: {security_metadata['security_version']}")
     
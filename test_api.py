@@ -0,0 +1,338 @@
+"""
+API tests for the FastAPI app, run against a fresh database in a temp directory.
+"""
+
+import hashlib
+import importlib
+import os
+import secrets
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from fastapi import HTTPException
+from fastapi.security import HTTPAuthorizationCredentials
+from fastapi.testclient import TestClient
+
+# A minimal one-page PDF
+PDF_BYTES = (
+    b"%PDF-1.4\n"
+    b"1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj\n"
+    b"2 0 obj<</Type/Pages/Kids[3 0 R]/Count 1>>endobj\n"
+    b"3 0 obj<</Type/Page/Parent 2 0 R/MediaBox[0 0 612 792]>>endobj\n"
+    b"trailer<</Root 1 0 R>>\n"
+    b"%%EOF"
+)
+
+@pytest.fixture(scope="module")
+def main(tmp_path_factory):
+    """Import the app with its database, PDFs and QR codes under a temp directory."""
+    workdir = tmp_path_factory.mktemp("app")
+    os.makedirs(workdir / "static")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        yield importlib.import_module("main")
+    finally:
+        os.chdir(cwd)
+
+@pytest.fixture(scope="module")
+def client(main):
+    with TestClient(main.app) as client:
+        yield client
+
+def register(client):
+    """Register and log in a new user; returns their auth header."""
+    email = f"{secrets.token_hex(4)}@example.com"
+    client.post("/register", json={"email": email, "password": "pw"})
+    token = client.post("/login", json={"email": email, "password": "pw"}).json()["access_token"]
+    return {"Authorization": f"Bearer {token}"}
+
+@pytest.fixture
+def headers(client):
+    """Auth header for a newly registered user."""
+    return register(client)
+
+def upload(client, headers, scan_limit):
+    """Upload PDF_BYTES and return its unique_id."""
+    response = client.post(
+        "/upload-pdf",
+        headers=headers,
+        files={"file": ("doc.pdf", PDF_BYTES, "application/pdf")},
+        data={"scan_limit": scan_limit}
+    )
+    assert response.status_code == 200
+    return response.json()["unique_id"]
+
+def scan_count(main, unique_id):
+    return main.get_document(unique_id)[4]
+
+def issue_download_url(client, headers, unique_id):
+    """Verify the document's own QR code through /verify-secure and return its download_url."""
+    qr = client.get(f"/qr/{unique_id}").content
+    response = client.post(
+        f"/verify-secure/{unique_id}",
+        headers=headers,
+        files={"file": ("qr.png", qr, "image/png")}
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["success"] and data["verdict"] == "AUTHENTIC"
+    assert "pdf_data" not in data
+    return data["download_url"]
+
+# Access tokens
+
+def bearer(token):
+    return {"Authorization": f"Bearer {token}"}
+
+def is_authorized(client, token):
+    """Whether the token passes verify_token (an unknown document is then a 404)."""
+    status = client.get("/verify/nope", headers=bearer(token)).status_code
+    assert status in (401, 404)
+    return status == 404
+
+def token_in_db(main, token):
+    with main.get_conn() as conn:
+        return conn.execute("SELECT 1 FROM tokens WHERE token = ?", (token,)).fetchone() is not None
+
+def test_valid_token_is_accepted_from_cache_and_database(main, client):
+    token = main.create_access_token(1)
+    assert token in main._token_cache
+    assert is_authorized(client, token)
+
+    main._token_cache.pop(token)
+    assert is_authorized(client, token)
+    assert token in main._token_cache
+
+def test_unknown_token_is_401(client):
+    assert not is_authorized(client, "not-a-token")
+
+def test_expired_token_is_401(main, client, monkeypatch):
+    monkeypatch.setattr(main, "ACCESS_TOKEN_TTL_SECONDS", 0)
+    token = main.create_access_token(1)
+
+    # Cached, but the cache entry is expired too
+    assert token in main._token_cache
+    assert not is_authorized(client, token)
+
+def test_purge_removes_only_expired_tokens(main, client, monkeypatch):
+    live = main.create_access_token(1)
+    monkeypatch.setattr(main, "ACCESS_TOKEN_TTL_SECONDS", -1)
+    expired = main.create_access_token(1)
+
+    main.purge_expired_tokens()
+
+    assert token_in_db(main, live) and is_authorized(client, live)
+    assert not token_in_db(main, expired) and not is_authorized(client, expired)
+
+def test_token_cache_is_bounded(main, client, monkeypatch):
+    monkeypatch.setattr(main, "TOKEN_CACHE_MAX_SIZE", 3)
+    main._token_cache.clear()
+    tokens = [main.create_access_token(1) for _ in range(5)]
+
+    assert len(main._token_cache) == 3
+    assert tokens[0] not in main._token_cache
+
+    # Evicted tokens are still valid, from the database
+    assert is_authorized(client, tokens[0])
+
+# Passwords
+
+def test_password_hash_round_trip(main):
+    password_hash = main.hash_password("pw")
+    assert main.verify_password("pw", password_hash)
+    assert not main.verify_password("wrong", password_hash)
+    assert not main.password_needs_rehash(password_hash)
+
+def test_legacy_sha256_hash_verifies_and_needs_rehash(main):
+    legacy_hash = hashlib.sha256(b"pw").hexdigest()
+    assert main.verify_password("pw", legacy_hash)
+    assert main.password_needs_rehash(legacy_hash)
+
+@pytest.mark.parametrize("password_hash", [
+    "pbkdf2_sha256$",
+    "pbkdf2_sha256$1000$abcd",
+    "pbkdf2_sha256$lots$abcd$abcd",
+    "pbkdf2_sha256$0$abcd$abcd",
+    "pbkdf2_sha256$99999999999999999999$abcd$abcd",
+    "pbkdf2_sha256$1000$not-hex$abcd",
+    "pbkdf2_sha256$1000$abcd$não-hex",
+])
+def test_malformed_password_hash_never_matches(main, password_hash):
+    assert main.verify_password("pw", password_hash) is False
+
+def test_login_with_malformed_stored_hash_is_401(main, client):
+    email = f"{secrets.token_hex(4)}@example.com"
+    main.create_user(email, "pbkdf2_sha256$broken")
+    response = client.post("/login", json={"email": email, "password": "pw"})
+    assert response.status_code == 401
+
+# Uploads
+
+def test_failed_upload_removes_its_files(main, client, headers, monkeypatch):
+    def insert_document(*args):
+        raise RuntimeError("insert failed")
+    monkeypatch.setattr(main, "insert_document", insert_document)
+    before = (set(os.listdir(main.PDF_DIR)), set(os.listdir(main.QR_DIR)))
+
+    with pytest.raises(RuntimeError):
+        upload(client, headers, scan_limit=1)
+
+    assert (set(os.listdir(main.PDF_DIR)), set(os.listdir(main.QR_DIR))) == before
+
+# Scan limits (/verify)
+
+def test_scans_stop_at_limit(main, client, headers):
+    unique_id = upload(client, headers, scan_limit=2)
+
+    for expected in ("1", "2"):
+        response = client.get(f"/verify/{unique_id}", headers=headers)
+        assert response.status_code == 200
+        assert response.headers["X-Scan-Count"] == expected
+
+    response = client.get(f"/verify/{unique_id}", headers=headers)
+    assert response.status_code == 410
+    assert response.json()["detail"] == "Scan limit exceeded (2/2)"
+    assert scan_count(main, unique_id) == 2
+
+def test_scan_of_unknown_document_is_404(client, headers):
+    assert client.get("/verify/nope", headers=headers).status_code == 404
+
+def test_scan_by_other_user_is_403_and_not_counted(main, client, headers):
+    unique_id = upload(client, headers, scan_limit=1)
+    other = register(client)
+
+    assert client.get(f"/verify/{unique_id}", headers=other).status_code == 403
+    assert scan_count(main, unique_id) == 0
+
+    # Ownership is checked before the limit
+    assert client.get(f"/verify/{unique_id}", headers=headers).status_code == 200
+    assert client.get(f"/verify/{unique_id}", headers=other).status_code == 403
+
+def test_concurrent_scans_respect_limit(main, client, headers):
+    unique_id = upload(client, headers, scan_limit=3)
+    user_id = main.verify_token(HTTPAuthorizationCredentials(
+        scheme="Bearer", credentials=headers["Authorization"].split()[1]
+    ))
+
+    def claim(_):
+        try:
+            return main.claim_scan(unique_id, user_id)[4]
+        except HTTPException as e:
+            return e.status_code
+
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        results = list(executor.map(claim, range(20)))
+
+    assert sorted(r for r in results if r != 410) == [1, 2, 3]
+    assert results.count(410) == 17
+    assert scan_count(main, unique_id) == 3
+
+# Download links (/verify-secure + /download)
+
+def test_download_link_uses_scan_on_redeem_only(main, client, headers):
+    unique_id = upload(client, headers, scan_limit=2)
+
+    url = issue_download_url(client, headers, unique_id)
+    assert scan_count(main, unique_id) == 0
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.content == PDF_BYTES
+    assert response.headers["X-Scan-Count"] == "1"
+    assert scan_count(main, unique_id) == 1
+
+def test_download_link_is_single_use(main, client, headers):
+    unique_id = upload(client, headers, scan_limit=2)
+    url = issue_download_url(client, headers, unique_id)
+
+    assert client.get(url).status_code == 200
+    assert client.get(url).status_code == 404
+    assert scan_count(main, unique_id) == 1
+
+def test_expired_download_link_does_not_use_a_scan(main, client, headers, monkeypatch):
+    unique_id = upload(client, headers, scan_limit=2)
+
+    monkeypatch.setattr(main, "DOWNLOAD_TOKEN_TTL_SECONDS", 0)
+    url = issue_download_url(client, headers, unique_id)
+
+    assert client.get(url).status_code == 410
+    assert scan_count(main, unique_id) == 0
+
+def test_download_with_missing_file_keeps_link_and_scan(main, client, headers):
+    unique_id = upload(client, headers, scan_limit=2)
+    url = issue_download_url(client, headers, unique_id)
+
+    pdf_path = os.path.join(main.PDF_DIR, f"{unique_id}.pdf")
+    os.rename(pdf_path, pdf_path + ".bak")
+    assert client.get(url).status_code == 404
+    assert scan_count(main, unique_id) == 0
+
+    os.rename(pdf_path + ".bak", pdf_path)
+    assert client.get(url).status_code == 200
+
+def test_download_links_respect_scan_limit(main, client, headers):
+    unique_id = upload(client, headers, scan_limit=1)
+    first = issue_download_url(client, headers, unique_id)
+    second = issue_download_url(client, headers, unique_id)
+
+    assert client.get(first).status_code == 200
+    assert client.get(second).status_code == 410
+    assert scan_count(main, unique_id) == 1
+
+def test_concurrent_download_redeems_respect_limit(main, client, headers):
+    unique_id = upload(client, headers, scan_limit=2)
+    tokens = [issue_download_url(client, headers, unique_id).rsplit("/", 1)[1] for _ in range(5)]
+
+    def redeem(token):
+        try:
+            return main.redeem_download_token(token)[4]
+        except HTTPException as e:
+            return e.status_code
+
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        results = list(executor.map(redeem, tokens))
+
+    assert sorted(results) == [1, 2, 410, 410, 410]
+    assert scan_count(main, unique_id) == 2
+
+# Stamping
+
+def test_stamp_reuses_stored_qr(main, client, headers, monkeypatch):
+    unique_id = upload(client, headers, scan_limit=1)
+
+    def generate_secure_qr_code(*args):
+        raise AssertionError("QR should be read from disk")
+    monkeypatch.setattr(main, "generate_secure_qr_code", generate_secure_qr_code)
+
+    response = client.get(f"/stamp-pdf/{unique_id}", headers=headers)
+    assert response.status_code == 200
+    assert response.content.startswith(b"%PDF")
+
+# QR images
+
+@pytest.mark.parametrize("if_none_match", [
+    "{etag}",
+    "W/{etag}",
+    '"other", W/{etag}',
+    "*",
+])
+def test_qr_conditional_request_is_304(client, headers, if_none_match):
+    unique_id = upload(client, headers, scan_limit=1)
+    etag = client.get(f"/qr/{unique_id}").headers["etag"]
+
+    response = client.get(f"/qr/{unique_id}", headers={"If-None-Match": if_none_match.format(etag=etag)})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+    assert response.content == b""
+
+def test_qr_stale_etag_is_200(client, headers):
+    unique_id = upload(client, headers, scan_limit=1)
+
+    response = client.get(f"/qr/{unique_id}", headers={"If-None-Match": '"stale"'})
+    assert response.status_code == 200
+    assert response.content.startswith(b"\x89PNG")
+
+def test_missing_qr_is_404(client):
+    assert client.get("/qr/nope").status_code == 404
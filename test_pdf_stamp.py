@@ -1,24 +1,83 @@
 
-import io
-from PIL import Image
-from pdf_utils import stamp_pdf_with_qr
+# pdf_utils (PyMuPDF, OpenCV, pypdf) is imported inside the functions that
+# use it, so importing or collecting this module stays cheap
 
-# Create a dummy PDF
-from pypdf import PdfWriter
-buffer = io.BytesIO()
-writer = PdfWriter()
-writer.add_blank_page(width=595, height=842)
-writer.write(buffer)
-pdf_bytes = buffer.getvalue()
+# A dummy PDF: one blank A4 page (595x842 pt), as written by pypdf's
+# PdfWriter.add_blank_page. Inlined so the script doesn't build it at runtime.
+pdf_bytes = (
+    b'%PDF-1.3\n'
+    b'%\xe2\xe3\xcf\xd3\n'
+    b'1 0 obj\n'
+    b'<<\n'
+    b'/Producer (pypdf)\n'
+    b'>>\n'
+    b'endobj\n'
+    b'2 0 obj\n'
+    b'<<\n'
+    b'/Type /Pages\n'
+    b'/Count 1\n'
+    b'/Kids [ 4 0 R ]\n'
+    b'>>\n'
+    b'endobj\n'
+    b'3 0 obj\n'
+    b'<<\n'
+    b'/Type /Catalog\n'
+    b'/Pages 2 0 R\n'
+    b'>>\n'
+    b'endobj\n'
+    b'4 0 obj\n'
+    b'<<\n'
+    b'/Type /Page\n'
+    b'/Resources <<\n'
+    b'>>\n'
+    b'/MediaBox [ 0.0 0.0 595 842 ]\n'
+    b'/Parent 2 0 R\n'
+    b'>>\n'
+    b'endobj\n'
+    b'xref\n'
+    b'0 5\n'
+    b'0000000000 65535 f \n'
+    b'0000000015 00000 n \n'
+    b'0000000054 00000 n \n'
+    b'0000000113 00000 n \n'
+    b'0000000162 00000 n \n'
+    b'trailer\n'
+    b'<<\n'
+    b'/Size 5\n'
+    b'/Root 3 0 R\n'
+    b'/Info 1 0 R\n'
+    b'>>\n'
+    b'startxref\n'
+    b'256\n'
+    b'%%EOF\n'
+)
 
-# Create a dummy QR
-qr_img = Image.new('RGB', (100, 100), color='black')
-qr_buffer = io.BytesIO()
-qr_img.save(qr_buffer, format='PNG')
-qr_bytes = qr_buffer.getvalue()
+# A dummy QR: 100x100 solid black RGB PNG (as saved by Pillow)
+qr_bytes = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000064000000640802000000ff8002030000003449444154789cedc1010d00"
+    "0000c2a0f74f6d0e37a000000000000000000000000000000000000000000000000000000000007e0c75940001a850f2"
+    "390000000049454e44ae426082"
+)
 
-try:
+def test_stamp_pdf_with_qr():
+    """The QR lands on the (last) page and the page count is unchanged."""
+    import pymupdf
+    from pdf_utils import stamp_pdf_with_qr
+    
     result = stamp_pdf_with_qr(pdf_bytes, qr_bytes)
-    print(f"Success! Output size: {len(result)} bytes")
-except Exception as e:
-    print(f"Error: {e}")
+    
+    with pymupdf.open(stream=result, filetype="pdf") as doc:
+        assert doc.page_count == 1
+        assert len(doc[-1].get_images()) == 1
+
+def main():
+    from pdf_utils import stamp_pdf_with_qr
+    
+    try:
+        result = stamp_pdf_with_qr(pdf_bytes, qr_bytes)
+        print(f"Success! Output size: {len(result)} bytes")
+    except Exception as e:
+        print(f"Error: {e}")
+
+if __name__ == "__main__":
+    main()
@@ -3,123 +3,184 @@ Test script for Secure PDF QR System
 Demonstrates the complete workflow using Python requests
 """
 
+import logging
+import os
+import sys
 import requests
-import json
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
+from typing import Final
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 BASE_URL = "http://127.0.0.1:8000"
+REGISTER_URL = f"{BASE_URL}/register"
+LOGIN_URL = f"{BASE_URL}/login"
+UPLOAD_URL = f"{BASE_URL}/upload-pdf"
+HEALTH_URL = f"{BASE_URL}/health"
 EMAIL = "demo@example.com"
 PASSWORD = "demo123"
 
+# Retry only failed connection attempts. A GET /verify/{id} uses up a scan as
+# soon as the server sees it, so retrying after a read error would burn a second one.
+RETRY = Retry(total=3, connect=3, read=0, status=0, backoff_factor=0.2)
+
+# Concurrent scans in the scan-limit test
+SCAN_WORKERS = 6
+
+# One connection pool shared by every session: keep-alive connections are
+# reused instead of opening a new TCP connection per request. urllib3's pool is
+# thread-safe, and 16 connections cover every concurrent scan.
+ADAPTER = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=RETRY)
+
+def new_session():
+    """Session that sends its requests through the shared ADAPTER."""
+    session = requests.Session()
+    session.mount("http://", ADAPTER)
+    session.mount("https://", ADAPTER)
+    return session
+
+# Session for the sequential steps; closing it at the end closes the shared pool
+SESSION = new_session()
+
+# Minimal one-page PDF uploaded by the workflow
+TEST_PDF_CONTENT: Final[bytes] = b"""%PDF-1.4
+1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj
+2 0 obj<</Type/Pages/Kids[3 0 R]/Count 1>>endobj
+3 0 obj<</Type/Page/Parent 2 0 R/MediaBox[0 0 612 792]/Contents 4 0 R>>endobj
+4 0 obj<</Length 44>>stream
+BT /F1 12 Tf 100 700 Td (Secure PDF Test) Tj ET
+endstream endobj
+xref 0 5
+0000000000 65535 f 
+0000000009 00000 n 
+0000000058 00000 n 
+0000000115 00000 n 
+0000000229 00000 n 
+trailer<</Size 5/Root 1 0 R>>
+startxref 322
+%%EOF"""
+
+# Downloads are written to disk in chunks of this size instead of buffered whole
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+log = logging.getLogger("test_workflow")
+
 def print_section(title):
     print(f"\n{'='*60}")
     print(f"  {title}")
     print(f"{'='*60}\n")
 
+def save_response(response, filename):
+    """Stream a (stream=True) response body to disk in chunks."""
+    # Chunks are already DOWNLOAD_CHUNK_SIZE, so write them straight to the
+    # file descriptor rather than through another buffered file object
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            view = memoryview(chunk)
+            while view:
+                view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+def scan(verify_url, scan_no):
+    """Run one verify request on its own session and return its log record as (fmt, *args)."""
+    # requests.Session is not thread-safe, so each concurrent scan gets its own
+    # session carrying a copy of the auth header. It is not closed here: that
+    # would close the shared ADAPTER pool, which SESSION closes at the end.
+    session = new_session()
+    session.headers.update(SESSION.headers)
+    with session.get(verify_url, stream=True) as response:
+        # Rejected scans are closed without downloading the error body
+        if response.status_code != 200:
+            return "Scan #%d: ❌ status=%d %s", scan_no, response.status_code, response.reason
+        
+        scan_count = response.headers.get('X-Scan-Count')
+        
+        # Save PDF (named by the server's scan count, since completion order varies)
+        pdf_filename = f"downloaded_{scan_count}.pdf"
+        save_response(response, pdf_filename)
+        return ("Scan #%d: ✅ status=%d count=%s/%s saved=%s",
+                scan_no, response.status_code, scan_count, response.headers.get('X-Scan-Limit'), pdf_filename)
+
 def main():
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stdout)
+    with SESSION:
+        run_workflow()
+
+def run_workflow():
     print_section("🔒 Secure PDF QR System - Python Test")
     
     # 1. Register
     print_section("1️⃣  Registering User")
     try:
-        response = requests.post(
-            f"{BASE_URL}/register",
+        response = SESSION.post(
+            REGISTER_URL,
             json={"email": EMAIL, "password": PASSWORD}
         )
         print(f"Status: {response.status_code}")
-        print(json.dumps(response.json(), indent=2))
+        print(response.text)
     except Exception as e:
         print(f"Registration failed (user might already exist): {e}")
     
     # 2. Login
     print_section("2️⃣  Logging In")
-    response = requests.post(
-        f"{BASE_URL}/login",
+    response = SESSION.post(
+        LOGIN_URL,
         json={"email": EMAIL, "password": PASSWORD}
     )
     print(f"Status: {response.status_code}")
     login_data = response.json()
-    print(json.dumps(login_data, indent=2))
+    print(response.text)
     
     token = login_data["access_token"]
-    headers = {"Authorization": f"Bearer {token}"}
+    SESSION.headers.update({"Authorization": f"Bearer {token}"})
     
     # 3. Create a test PDF
     print_section("3️⃣  Creating Test PDF")
-    pdf_content = b"""%PDF-1.4
-1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj
-2 0 obj<</Type/Pages/Kids[3 0 R]/Count 1>>endobj
-3 0 obj<</Type/Page/Parent 2 0 R/MediaBox[0 0 612 792]/Contents 4 0 R>>endobj
-4 0 obj<</Length 44>>stream
-BT /F1 12 Tf 100 700 Td (Secure PDF Test) Tj ET
-endstream endobj
-xref 0 5
-0000000000 65535 f 
-0000000009 00000 n 
-0000000058 00000 n 
-0000000115 00000 n 
-0000000229 00000 n 
-trailer<</Size 5/Root 1 0 R>>
-startxref 322
-%%EOF"""
-    
-    print("Test PDF created in memory")
+    print(f"Test PDF created in memory ({len(TEST_PDF_CONTENT)} bytes)")
     
     # 4. Upload PDF
     print_section("4️⃣  Uploading PDF with Scan Limit = 5")
-    files = {"file": ("test_document.pdf", BytesIO(pdf_content), "application/pdf")}
+    files = {"file": ("test_document.pdf", BytesIO(TEST_PDF_CONTENT), "application/pdf")}
     data = {"scan_limit": 5}
     
-    response = requests.post(
-        f"{BASE_URL}/upload-pdf",
-        headers=headers,
+    response = SESSION.post(
+        UPLOAD_URL,
         files=files,
         data=data
     )
     print(f"Status: {response.status_code}")
     upload_data = response.json()
-    print(json.dumps(upload_data, indent=2))
+    print(response.text)
     
     unique_id = upload_data["unique_id"]
+    verify_url = f"{BASE_URL}/verify/{unique_id}"
     
     # 5. Download QR Code
     print_section("5️⃣  Downloading QR Code")
-    response = requests.get(f"{BASE_URL}/qr/{unique_id}")
     qr_filename = f"qr_{unique_id}.png"
-    with open(qr_filename, "wb") as f:
-        f.write(response.content)
+    with SESSION.get(f"{BASE_URL}/qr/{unique_id}", stream=True) as response:
+        save_response(response, qr_filename)
     print(f"QR code saved: {qr_filename}")
-    print(f"QR URL: {BASE_URL}/verify/{unique_id}")
+    print(f"QR URL: {verify_url}")
     
     # 6. Verify multiple times
     print_section("6️⃣  Testing Scan Limit (5 scans allowed)")
     
-    for i in range(1, 7):  # Try 6 times (should fail on 6th)
-        print(f"\n--- Scan #{i} ---")
-        response = requests.get(
-            f"{BASE_URL}/verify/{unique_id}",
-            headers=headers
-        )
-        print(f"Status: {response.status_code}")
-        
-        if response.status_code == 200:
-            print(f"✅ Success!")
-            print(f"Scan Count: {response.headers.get('X-Scan-Count')}")
-            print(f"Scan Limit: {response.headers.get('X-Scan-Limit')}")
-            
-            # Save PDF
-            pdf_filename = f"downloaded_{i}.pdf"
-            with open(pdf_filename, "wb") as f:
-                f.write(response.content)
-            print(f"PDF saved: {pdf_filename}")
-        else:
-            print(f"❌ Failed!")
-            print(json.dumps(response.json(), indent=2))
+    # Try 6 times at once (exactly one should fail); the server claims scans
+    # atomically, so concurrent requests still respect the limit
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as executor:
+        futures = [executor.submit(scan, verify_url, i) for i in range(1, SCAN_WORKERS + 1)]
+        # One log line per scan, in submission order
+        for future in futures:
+            log.info(*future.result())
     
     # 7. Health Check
     print_section("🏥 Health Check")
-    response = requests.get(f"{BASE_URL}/health")
-    print(json.dumps(response.json(), indent=2))
+    response = SESSION.get(HEALTH_URL)
+    print(response.text)
     
     print_section("✅ Test Completed!")
     print(f"Check the generated files:")